@@ -0,0 +1,489 @@
+"""
+性能基准（不依赖 Streamlit）：用合成数据测关键环节的耗时和内存，改动前后各跑一次对比
+
+    python bench_wms.py suite --rows 10000,100000 --save 基准.json      # 记录基准
+    python bench_wms.py suite --rows 10000,100000 --compare 基准.json   # 对比，变差超过阈值时退出码为 1
+    python bench_wms.py parse --files 2 --rows 200000
+    python bench_wms.py formats --rows 200000
+    python bench_wms.py equivalence --rows 50000
+    python bench_wms.py fingerprint --size-mb 150
+
+suite：生成订单表（同样的参数生成的文件完全一样），逐个阶段计时并记录内存峰值：
+       文件指纹 → 按列解析 → 紧凑存储 → +号还原 → 匹配键清洗 → 去重建索引 → 基准订单解析 → 匹配计数 → 合并 → 导出 xlsx，
+       和模式有关的阶段 strict / loose 各测一次
+parse：多个上传文件按列解析，顺序解析 vs 进程池并行解析
+formats：同一份数据分别存成 xlsx / CSV（UTF-8、GBK）/ TSV / Parquet，按列读取的耗时对比（结果必须和 xlsx 一致）
+equivalence：随机生成各种脏订单号（转义+号、各种 Unicode 空白、控制字符、空值、数字、日期），
+             整列清洗和逐个清洗的结果必须完全一致，不一致时列出前几个并以退出码 1 结束
+fingerprint：两个上传文件每次重跑的指纹开销：改造前（复制字节 + md5）、首次流式计算、按 file_id 查表
+磁盘缓存在基准测试里关闭，每次都真实解析
+"""
+import argparse
+import hashlib
+import json
+import os
+import pickle
+import platform
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import zipfile
+from io import BytesIO
+
+# 基准测试要测真实解析，关闭磁盘缓存（必须在导入 wms_core 之前设置）
+os.environ["WMS_CACHE_MAX_MB"] = "0"
+
+import numpy as np
+import pandas as pd
+import xlsxwriter
+
+import wms_core
+
+# 生成的订单表：主键列、常用映射列，再加若干扩展列
+KEY_COLUMN = "订单编号"
+MAPPED_COLUMNS = ("金额", "状态", "快递单号")
+BASE_COLUMNS = ["订单编号", "线上订单号", "金额", "数量", "状态", "仓库", "快递单号", "备注"]
+STATUSES = ["已发货", "待发货", "已签收", "退货中", "已取消"]
+
+
+# --------------------------
+# 1. 合成数据
+# --------------------------
+def make_order_ids(rng, rows):
+    """不重复的订单号，格式和真实数据一样：6位日期-15位流水号，例如 260209-171976957502069"""
+    days = rng.integers(1, 29, rows)
+    serials = 171976950000000 + rng.permutation(rows * 4)[:rows]
+    return [f"2602{d:02d}-{s}" for d, s in zip(days, serials)]
+
+def add_noise(rng, ids):
+    """
+    按真实导出文件里常见的问题加噪声，返回（写进表格的文本, 清洗后应该匹配到的订单号）：
+    带+号的组合单号被 Excel 转义成 _x002B_、零宽空格、不间断空格、首尾空格、重复主键
+    """
+    cells, clean = list(ids), list(ids)
+    kind = rng.random(len(ids))
+    for i in np.flatnonzero(kind < 0.03):
+        clean[i] = f"{ids[i]}+{i % 9 + 1}"
+        cells[i] = f"{ids[i]}_x002B_{i % 9 + 1}"
+    for i in np.flatnonzero((kind >= 0.03) & (kind < 0.05)):
+        cells[i] = ids[i][:7] + "\u200b" + ids[i][7:]
+    for i in np.flatnonzero((kind >= 0.05) & (kind < 0.07)):
+        cells[i] = ids[i] + "\xa0"
+    for i in np.flatnonzero((kind >= 0.07) & (kind < 0.09)):
+        cells[i] = f" {ids[i]} "
+    # 约 2% 的行重复前面某一行的主键（合并时取第一次出现的行）
+    for i in np.flatnonzero((kind >= 0.09) & (kind < 0.11)):
+        if i > 0:
+            j = int(rng.integers(0, i))
+            cells[i], clean[i] = cells[j], clean[j]
+    return cells, clean
+
+def unescape_plus_sign(path):
+    """
+    xlsxwriter 会把文本里的 _x002B_ 写成 _x005F_x002B_（表示字面文本），
+    真实导出文件里是 _x002B_ 本身，这里把工作表 XML 改回去（分块流式替换，不整个读进内存）
+    """
+    src, dst = "_x005F_x002B_".encode(), "_x002B_".encode()
+    tmp = path + ".tmp"
+    with zipfile.ZipFile(path) as zin, zipfile.ZipFile(tmp, "w", zipfile.ZIP_DEFLATED) as zout:
+        for info in zin.infolist():
+            with zin.open(info) as fin, zout.open(info.filename, "w", force_zip64=True) as fout:
+                tail = b""
+                while True:
+                    chunk = fin.read(1 << 20)
+                    if not chunk:
+                        break
+                    data = (tail + chunk).replace(src, dst)
+                    # 末尾留一段不输出，防止要替换的内容正好被分块切开
+                    tail = data[-(len(src) - 1):]
+                    fout.write(data[:-(len(src) - 1)])
+                fout.write(tail)
+    os.replace(tmp, path)
+
+def make_order_workbook(path, rows, extra_cols=50, seed=0):
+    """
+    生成订单表 xlsx 和对应的基准订单号 txt（同名 .txt）
+    基准订单号：约 85% 在表里（其中每 20 个有 1 个去掉了横杠，只有宽松模式能匹配上），其余表里没有
+    """
+    rng = np.random.default_rng(seed)
+    ids = make_order_ids(rng, rows)
+    cells, clean = add_noise(rng, ids)
+    amounts = rng.integers(100, 100000, rows) / 100
+    counts = rng.integers(1, 20, rows)
+    statuses = rng.integers(0, len(STATUSES), rows)
+    extra = rng.integers(0, 1000000, (min(rows, 1000), extra_cols))
+
+    workbook = xlsxwriter.Workbook(path, {"constant_memory": True})
+    ws = workbook.add_worksheet("订单")
+    ws.write_row(0, 0, BASE_COLUMNS + [f"扩展列{j + 1}" for j in range(extra_cols)])
+    for r in range(rows):
+        # 扩展列按行循环取值，整数、小数、短文本混在一起
+        ext = extra[r % len(extra)]
+        ws.write_row(r + 1, 0, [
+            cells[r], f"P{r:012d}", amounts[r], int(counts[r]), STATUSES[statuses[r]], f"仓{r % 7}",
+            f"SF{r:012d}", "" if r % 5 else "加急",
+        ] + [int(v) if j % 3 == 0 else (v / 100 if j % 3 == 1 else f"E{v}") for j, v in enumerate(ext)])
+    workbook.close()
+    unescape_plus_sign(path)
+
+    pick = rng.random(rows)
+    base = [clean[i] for i in np.flatnonzero(pick < 0.85)]
+    base = [o.replace("-", "", 1) if k % 20 == 0 else o for k, o in enumerate(base)]
+    base += [f"260299-{999000000000000 + i}" for i in range(rows - len(base))]
+    base = [base[i] for i in rng.permutation(len(base))]
+    with open(os.path.splitext(path)[0] + ".txt", "w", encoding="utf-8") as f:
+        f.write("\n".join(base))
+
+def get_dataset(data_dir, rows, extra_cols, seed):
+    """返回（xlsx 路径, 基准订单号 txt 路径），同样的参数只生成一次，生成过的直接复用"""
+    os.makedirs(data_dir, exist_ok=True)
+    path = os.path.join(data_dir, f"orders_{rows}_{extra_cols}_{seed}.xlsx")
+    base_path = os.path.splitext(path)[0] + ".txt"
+    if not (os.path.exists(path) and os.path.exists(base_path)):
+        started = time.perf_counter()
+        make_order_workbook(path, rows, extra_cols, seed)
+        print(f"  已生成 {path}（{time.perf_counter() - started:.1f} 秒）")
+    return path, base_path
+
+
+# --------------------------
+# 2. 计时和内存峰值
+# --------------------------
+class PeakMemory:
+    """
+    统计一段代码运行期间内存比开始时最多多用了多少（peak_mb）：
+    能读到进程内存时（Linux，或装了 psutil）后台线程每 2 毫秒采样一次常驻内存，pandas / Arrow / openpyxl 的分配都算在内；
+    否则退回 tracemalloc（只统计 Python 分配，Arrow 的内存不计入，数字偏小）
+    """
+    use_rss = wms_core.current_rss() is not None
+
+    def __enter__(self):
+        if self.use_rss:
+            self.start = self.peak = wms_core.current_rss()
+            self.stop = threading.Event()
+            self.thread = threading.Thread(target=self.sample, daemon=True)
+            self.thread.start()
+        else:
+            tracemalloc.start()
+        return self
+
+    def sample(self):
+        while not self.stop.wait(0.002):
+            self.peak = max(self.peak, wms_core.current_rss())
+
+    def __exit__(self, *exc):
+        if self.use_rss:
+            self.stop.set()
+            self.thread.join()
+            self.peak = max(self.peak, wms_core.current_rss())
+            self.peak_mb = (self.peak - self.start) / 1024 / 1024
+        else:
+            self.peak_mb = tracemalloc.get_traced_memory()[1] / 1024 / 1024
+            tracemalloc.stop()
+
+def timed(fn, repeat):
+    """跑 repeat 次取最短时间"""
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = fn()
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+def run_stage(results, rows, stage, mode, fn, repeat):
+    """跑一个阶段：第一次同时测内存峰值，耗时取 repeat 次里最短的；结果记到 results，返回阶段的输出"""
+    with PeakMemory() as mem:
+        started = time.perf_counter()
+        output = fn()
+        seconds = time.perf_counter() - started
+    if repeat > 1:
+        seconds = min(seconds, timed(fn, repeat - 1)[0])
+    results[f"{rows}:{stage}:{mode}"] = {"seconds": round(seconds, 4), "peak_mb": round(mem.peak_mb, 1)}
+    print(f"  {stage:<12}{mode:<8}{seconds:10.3f} 秒{mem.peak_mb:10.1f} MB")
+    return output
+
+
+# --------------------------
+# 3. 基准场景
+# --------------------------
+def bench_suite(args):
+    results = {}
+    sizes = [int(n) for n in str(args.rows).split(",")]
+    columns = (KEY_COLUMN,) + MAPPED_COLUMNS
+    for rows in sizes:
+        print(f"suite：{rows} 行 × {len(BASE_COLUMNS) + args.extra_cols} 列，取 {args.repeat} 次最短")
+        path, base_path = get_dataset(args.data_dir, rows, args.extra_cols, args.seed)
+        with open(path, "rb") as f:
+            file_bytes = f.read()
+        lines = wms_core.read_text_lines(base_path)
+        print(f"  {'阶段':<10}{'模式':<6}{'耗时':>10}{'内存峰值':>10}")
+
+        run_stage(results, rows, "hash", "-", lambda: wms_core.hash_file_content(BytesIO(file_bytes)), args.repeat)
+        parsed = run_stage(results, rows, "parse", "-", lambda: wms_core.read_excel_columns(file_bytes, columns), args.repeat)
+        # 会话里长期保存的是紧凑表，后面的阶段都用它；同时记录比逐个 Python 字符串的 object 列省了多少
+        df = run_stage(results, rows, "compact", "-", lambda: wms_core.compact_table(parsed, KEY_COLUMN), args.repeat)
+        object_mb = wms_core.table_memory_bytes(parsed.astype(object)) / 1024 / 1024
+        table_mb = wms_core.table_memory_bytes(df) / 1024 / 1024
+        results[f"{rows}:compact:-"]["table_mb"] = round(table_mb, 2)
+        print(f"  {'':<20}表数据 {object_mb:.1f} MB（object 列）→ {table_mb:.1f} MB（{object_mb / table_mb:.1f}x）")
+        run_stage(results, rows, "restore", "-",
+                  lambda: [wms_core.restore_plus_sign_series(df[c]) for c in (KEY_COLUMN,) + MAPPED_COLUMNS], args.repeat)
+        for mode in ("strict", "loose"):
+            run_stage(results, rows, "normalize", mode, lambda: wms_core.clean_order_ids(df[KEY_COLUMN], mode), args.repeat)
+        # 去重建索引：两种模式的索引一次建好
+        index = run_stage(results, rows, "index", "both", lambda: wms_core.build_match_index(df[KEY_COLUMN]), args.repeat)
+
+        tables = [{"name": "表1", "df": df, "index": index, "mappings": [(c, c) for c in MAPPED_COLUMNS], "aliases": None}]
+        final_df = None
+        for mode in ("strict", "loose"):
+            base_orders, base_keys = run_stage(
+                results, rows, "base", mode, lambda: wms_core.parse_base_orders(lines, mode), args.repeat)
+            positions = run_stage(
+                results, rows, "match", mode, lambda: wms_core.lookup_match_positions(index, mode, base_keys), args.repeat)
+            print(f"  {'':<20}匹配 {int((positions >= 0).sum())} / {len(base_keys)} 条")
+            merged, _ = run_stage(
+                results, rows, "merge", mode,
+                lambda: wms_core.integrate_tables(base_orders, base_keys, mode, tables), args.repeat)
+            if final_df is None:
+                final_df = merged
+        with tempfile.TemporaryDirectory() as tmp:
+            out = os.path.join(tmp, "结果.xlsx")
+            run_stage(results, rows, "export", "xlsx", lambda: wms_core.export_excel(final_df, out), args.repeat)
+
+    if args.save:
+        report = {
+            "env": {"python": platform.python_version(), "pandas": pd.__version__, "numpy": np.__version__,
+                    "platform": platform.platform(), "calamine": wms_core.HAS_CALAMINE, "xxhash": wms_core.HAS_XXHASH},
+            "args": {"rows": sizes, "extra_cols": args.extra_cols, "seed": args.seed, "repeat": args.repeat},
+            "results": results,
+        }
+        with open(args.save, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"结果已保存到 {args.save}")
+    if args.compare:
+        return compare_with_baseline(results, args)
+    return 0
+
+def compare_with_baseline(results, args):
+    """和保存的基准对比：耗时或内存峰值超过基准的 (1 + 阈值) 倍算退化；数字太小的噪声大，不参与比较"""
+    with open(args.compare, encoding="utf-8") as f:
+        baseline = json.load(f)["results"]
+    regressions = []
+    for name, cur in results.items():
+        old = baseline.get(name)
+        if old is None:
+            continue
+        if old["seconds"] >= args.min_seconds and cur["seconds"] > old["seconds"] * (1 + args.threshold):
+            regressions.append(f"{name} 耗时 {old['seconds']:.3f} → {cur['seconds']:.3f} 秒")
+        if old["peak_mb"] >= args.min_mb and cur["peak_mb"] > old["peak_mb"] * (1 + args.threshold):
+            regressions.append(f"{name} 内存峰值 {old['peak_mb']:.1f} → {cur['peak_mb']:.1f} MB")
+        if "table_mb" in old and cur["table_mb"] > old["table_mb"] * (1 + args.threshold):
+            regressions.append(f"{name} 表数据 {old['table_mb']:.1f} → {cur['table_mb']:.1f} MB")
+    if regressions:
+        print(f"❌ 有 {len(regressions)} 项比基准差了 {args.threshold:.0%} 以上：")
+        for line in regressions:
+            print(f"  - {line}")
+        return 1
+    print(f"✅ 与基准 {args.compare} 相比没有超过 {args.threshold:.0%} 的退化")
+    return 0
+
+def bench_parse(args):
+    columns = (KEY_COLUMN,) + MAPPED_COLUMNS
+    blobs = []
+    for i in range(args.files):
+        path, _ = get_dataset(args.data_dir, args.rows, args.extra_cols, args.seed + i)
+        with open(path, "rb") as f:
+            blobs.append(f.read())
+    print(f"parse：{args.files} 个文件 × {args.rows} 行，读取 {len(columns)} 列，"
+          f"进程池 {wms_core.PARSE_WORKERS} 个进程，取 {args.repeat} 次最短")
+    requests = [(f"bench{i}", lambda b=b: b, columns, None) for i, b in enumerate(blobs)]
+
+    sequential, expected = timed(lambda: [wms_core.read_excel_columns(b, columns) for b in blobs], args.repeat)
+    print(f"  顺序解析          {sequential:8.2f} 秒")
+
+    # 先跑一次把进程池启动起来：进程启动开销只在服务第一次并行解析时出现，不计入对比
+    wms_core.load_columns_many(requests)
+    parallel, got = timed(lambda: wms_core.load_columns_many(requests), args.repeat)
+    print(f"  进程池并行解析    {parallel:8.2f} 秒（{sequential / parallel:.2f}x）")
+    for a, b in zip(expected, got):
+        assert a.astype(str).equals(b.astype(str)), "并行解析结果与顺序解析不一致"
+
+    # 子进程把结果传回主进程的开销：逐个 pickle 字符串对象 vs Arrow IPC 连续缓冲区
+    df = expected[0].astype(object)
+    via_pickle, _ = timed(lambda: pickle.loads(pickle.dumps(df)), args.repeat)
+    via_ipc, _ = timed(lambda: wms_core.table_from_ipc(wms_core.table_to_ipc(df)), args.repeat)
+    print(f"  结果回传 pickle   {via_pickle:8.3f} 秒 / Arrow IPC {via_ipc:.3f} 秒（单个文件）")
+    return 0
+
+
+def bench_formats(args):
+    columns = (KEY_COLUMN,) + MAPPED_COLUMNS
+    path, _ = get_dataset(args.data_dir, args.rows, args.extra_cols, args.seed)
+    with open(path, "rb") as f:
+        xlsx_bytes = f.read()
+    # 其他格式都从 xlsx 读出来的全部列转换，内容完全一样（WMS、数据组导出的也都是文本）
+    header = wms_core.read_table_headers(xlsx_bytes, [None])[None]
+    full = wms_core.read_table_columns(xlsx_bytes, header)
+    variants = [("xlsx", xlsx_bytes)]
+    for name, sep, encoding in (("csv", ",", "utf-8-sig"), ("csv_gbk", ",", "gb18030"), ("tsv", "\t", "utf-8")):
+        variants.append((name, full.to_csv(index=False, sep=sep).encode(encoding)))
+    sink = BytesIO()
+    full.to_parquet(sink, index=False)
+    variants.append(("parquet", sink.getvalue()))
+
+    print(f"formats：{args.rows} 行 × {len(header)} 列，读取 {len(columns)} 列，取 {args.repeat} 次最短")
+    print(f"  {'格式':<10}{'文件':>10}{'耗时':>10}{'内存峰值':>10}")
+    expected, xlsx_seconds = None, None
+    for name, data in variants:
+        with PeakMemory() as mem:
+            seconds, df = timed(lambda: wms_core.read_table_columns(data, columns), args.repeat)
+        if expected is None:
+            expected, xlsx_seconds = df, seconds
+        assert expected.astype(str).equals(df.astype(str)), f"{name} 读出来的内容和 xlsx 不一致"
+        print(f"  {name:<10}{len(data) / 1024 / 1024:8.1f} MB{seconds:10.3f} 秒{mem.peak_mb:10.1f} MB"
+              f"  {xlsx_seconds / seconds:6.1f}x")
+    return 0
+
+
+# 拼脏订单号用的片段：正常字符、Excel 转义的+号（大小写混用）、清洗正则覆盖的全部空白和不可见字符
+FUZZ_PIECES = (
+    list("0123456789") * 4 + list("ABCxyz+-_/#.") + ["_x002B_", "_X002b_", "_x002b_", "_x002B", "x002B_", "_x005F_x002B_"]
+    + list("\x00\x01\t\n\r\x1f\x7f \x85\xa0\u1680\u2000\u200a\u200b\u200c\u200d\u2028\u2029\u202f\u205f\u3000\ufeff")
+    + ["订", "单", "①", "٣"]
+)
+
+def make_fuzz_values(rng, rows):
+    """随机脏值：大部分是拼出来的字符串，少量空值、空串、整数、小数、日期"""
+    values = []
+    for kind in rng.random(rows):
+        if kind < 0.02:
+            values.append(None)
+        elif kind < 0.03:
+            values.append(np.nan)
+        elif kind < 0.05:
+            values.append("")
+        elif kind < 0.07:
+            values.append(int(rng.integers(-10 ** 12, 10 ** 12)))
+        elif kind < 0.08:
+            values.append(float(rng.normal() * 1000))
+        elif kind < 0.09:
+            values.append(pd.Timestamp("2026-02-09") + pd.Timedelta(seconds=int(rng.integers(0, 10 ** 7))))
+        else:
+            values.append("".join(FUZZ_PIECES[i] for i in rng.integers(0, len(FUZZ_PIECES), int(rng.integers(1, 30)))))
+    return values
+
+
+def same_cell(a, b):
+    """两个单元格的值相同（空值和空值算相同）"""
+    if isinstance(a, str) or isinstance(b, str):
+        return a == b
+    return (pd.isna(a) and pd.isna(b)) or a == b
+
+
+def bench_equivalence(args):
+    rng = np.random.default_rng(args.seed)
+    mixed = make_fuzz_values(rng, args.rows)
+    text = [v for v in mixed if isinstance(v, str)]
+    print(f"equivalence：{len(mixed)} 个混合值（其中 {len(text)} 个字符串），种子 {args.seed}")
+    failed = 0
+    for label, values in (("混合列", mixed), ("纯文本列", text)):
+        series = pd.Series(values, dtype=object)
+        for mode in ("strict", "loose"):
+            seconds_one, expected = timed(lambda: [wms_core.clean_order_id(v, mode) for v in values], args.repeat)
+            seconds_vec, got = timed(lambda: wms_core.clean_order_ids(series, mode), args.repeat)
+            diff = [i for i, (a, b) in enumerate(zip(expected, got.tolist())) if a != b]
+            failed += len(diff)
+            print(f"  {label} {mode:<7}逐个 {seconds_one:.3f} 秒 / 整列 {seconds_vec:.3f} 秒，不一致 {len(diff)} 个")
+            for i in diff[:5]:
+                print(f"    {values[i]!r} → 逐个 {expected[i]!r}，整列 {got.iloc[i]!r}")
+        expected = [wms_core.restore_plus_sign(v) for v in values]
+        got = wms_core.restore_plus_sign_series(series).tolist()
+        diff = [i for i, (a, b) in enumerate(zip(expected, got)) if not same_cell(a, b)]
+        failed += len(diff)
+        print(f"  {label} +号还原  不一致 {len(diff)} 个")
+        for i in diff[:5]:
+            print(f"    {values[i]!r} → 逐个 {expected[i]!r}，整列 {got[i]!r}")
+    return 1 if failed else 0
+
+
+def bench_fingerprint(args):
+    """每次重跑都要给两个上传文件取指纹，比较改造前、首次计算和之后查表的耗时"""
+    rng = np.random.default_rng(args.seed)
+    size = int(args.size_mb * 1024 * 1024)
+    uploads = []
+    for i in range(2):
+        upload = BytesIO(rng.bytes(size))
+        upload.file_id = f"upload-{i}"
+        uploads.append(upload)
+    print(f"fingerprint：2 个上传文件 × {args.size_mb} MB，xxhash={'有' if wms_core.HAS_XXHASH else '无'}，"
+          f"取 {args.repeat} 次最短")
+
+    old, _ = timed(lambda: [hashlib.md5(u.getvalue()).hexdigest() for u in uploads], args.repeat)
+    first, _ = timed(lambda: [wms_core.memo_file_hash(u, {}) for u in uploads], args.repeat)
+    memo = {}
+    for upload in uploads:
+        wms_core.memo_file_hash(upload, memo)
+    started = time.perf_counter()
+    for _ in range(args.reruns):
+        for upload in uploads:
+            wms_core.memo_file_hash(upload, memo)
+    rerun = (time.perf_counter() - started) / args.reruns
+    print(f"  改造前（复制 + md5）  {old * 1000:10.1f} 毫秒 / 次重跑")
+    print(f"  首次流式计算          {first * 1000:10.1f} 毫秒（每次上传只算一次）")
+    print(f"  之后按 file_id 查表   {rerun * 1e6:10.2f} 微秒 / 次重跑（{args.reruns} 次平均）")
+    return 0
+
+
+def add_data_args(parser, rows):
+    parser.add_argument("--rows", default=rows, help="行数")
+    parser.add_argument("--extra-cols", type=int, default=50, help="扩展列数量")
+    parser.add_argument("--seed", type=int, default=0, help="随机种子，相同参数生成完全相同的数据")
+    parser.add_argument("--repeat", type=int, default=3, help="重复次数，取最短时间")
+    parser.add_argument("--data-dir", default=os.path.join(tempfile.gettempdir(), "wms_bench_data"),
+                        help="生成的测试文件存放目录（生成过的直接复用）")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="订单整合性能基准")
+    sub = parser.add_subparsers(dest="scenario", required=True)
+
+    p = sub.add_parser("suite", help="逐阶段计时 + 内存峰值，可保存基准、对比退化")
+    add_data_args(p, "10000,100000")
+    p.add_argument("--save", help="把结果保存成 JSON（作为以后对比的基准）")
+    p.add_argument("--compare", help="和之前保存的基准 JSON 对比")
+    p.add_argument("--threshold", type=float, default=0.2, help="退化阈值，默认 0.2（差 20%% 以上算退化）")
+    p.add_argument("--min-seconds", type=float, default=0.05, help="基准耗时低于这个值的阶段不比较耗时（噪声太大）")
+    p.add_argument("--min-mb", type=float, default=20, help="基准内存峰值低于这个值的阶段不比较内存")
+    p.set_defaults(func=bench_suite)
+
+    p = sub.add_parser("parse", help="多个文件顺序解析 vs 进程池并行解析")
+    add_data_args(p, 200000)
+    p.add_argument("--files", type=int, default=2, help="文件数量")
+    p.set_defaults(func=bench_parse)
+
+    p = sub.add_parser("formats", help="同一份数据 xlsx / CSV / TSV / Parquet 按列读取的耗时对比")
+    add_data_args(p, 200000)
+    p.set_defaults(func=bench_formats)
+
+    p = sub.add_parser("equivalence", help="整列清洗和逐个清洗的结果逐个对比（随机脏订单号）")
+    add_data_args(p, 50000)
+    p.set_defaults(func=bench_equivalence)
+
+    p = sub.add_parser("fingerprint", help="上传文件每次重跑的指纹开销：首次计算 vs 按 file_id 查表")
+    p.add_argument("--size-mb", type=float, default=150, help="每个上传文件的大小（MB）")
+    p.add_argument("--reruns", type=int, default=100000, help="模拟重跑次数")
+    p.add_argument("--repeat", type=int, default=3, help="重复次数，取最短时间")
+    p.add_argument("--seed", type=int, default=0, help="随机种子")
+    p.set_defaults(func=bench_fingerprint)
+
+    args = parser.parse_args(argv)
+    if args.scenario in ("parse", "formats", "equivalence"):
+        args.rows = int(args.rows)
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,8 +1,20 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
+import os
+import functools
+from contextlib import contextmanager
 from io import BytesIO
-import re
-import hashlib
+from wms_core import (
+    append_profile_log, as_key_index, BackgroundJob, base_order_lines, BASE_ORDER_COLUMN, DISK_CACHE_MAX_BYTES,
+    build_match_index, build_ngram_index, clean_order_ids, detect_table_format, disk_cache_clear, disk_cache_usage,
+    excel_sheet_count, EXPORT_FORMATS, export_result, get_disk_cache_stats, get_load_stats, hash_file_content, history_clear, history_ingest, history_stats, HISTORY_DB_PATH,
+    HISTORY_ENABLED, integration_fingerprint, load_headers, load_sheet_names, load_sheets_columns_many, lookup_match_positions,
+    match_index_bytes, memo_file_hash, merge_sheet_headers, parse_base_orders, PROFILE_ENABLED, PROFILE_LOG_PATH,
+    read_base_order_lines, restore_plus_sign_series, run_integration, SHARED_STORE, StageProfiler, StoreOwner,
+    suggest_similar_keys, summarize_profile_log, TABLE_FORMAT_LABELS, TABLE_UPLOAD_TYPES, table_memory_bytes,
+    take_by_positions, TEXT_SNIFF_BYTES,
+)
 
 # ===================== 页面全局配置 =====================
 st.set_page_config(
@@ -55,78 +67,153 @@ h2, h3, h4 {
 </style>
 """, unsafe_allow_html=True)
 
-# ===================== 核心函数（彻底修复0匹配+完美保留+号）=====================
-# 预编译正则，提升性能
-# 1. 只去除不可见字符、零宽空格、多余空格，不碰正常字符
-CLEAN_PATTERN = re.compile(r'[\u200b\u200c\u200d\uFEFF\u00A0\x00-\x1F\x7F\s]+')
-# 2. 专门处理Excel的_x00XX_转义，只还原+号，不碰其他内容
-EXCEL_PLUS_PATTERN = re.compile(r'_x002B_', re.IGNORECASE)
-# 3. 宽松匹配模式：只保留数字，解决格式差异问题
-ONLY_NUMBER_PATTERN = re.compile(r'[^0-9]')
-
-# --------------------------
-# 1. 完美修复+号，不修改正常订单号
-# --------------------------
-def restore_plus_sign(s):
-    """
-    只还原Excel里的_x002B_为+号，不修改其他任何正常字符
-    彻底解决之前解码改坏订单号的问题
-    """
-    if not isinstance(s, str):
-        return s
-    # 只替换_x002B_为+号，大小写都兼容
-    return EXCEL_PLUS_PATTERN.sub('+', s)
+# ===================== 页面缓存封装 =====================
+@st.cache_data(ttl=3600)
+def read_sheet_names_cached(_file, file_hash):
+    """带缓存的工作表列表：只读工作簿目录，不解析任何单元格"""
+    try:
+        return load_sheet_names(file_hash, _file.getvalue)
+    except Exception as e:
+        st.error(f"文件读取失败：{str(e)}")
+        return None
 
-def clean_order_id(x, match_mode="strict"):
-    """
-    订单号清洗，分两种匹配模式：
-    - strict严格模式：只去空格和不可见字符，完整保留订单号所有内容（字母、数字、+、横杠、下划线）
-    - loose宽松模式：只保留数字，彻底解决格式差异导致的0匹配问题
-    """
-    if pd.isna(x) or x == "" or x is None:
-        return ""
-    # 第一步：先还原+号
-    s = restore_plus_sign(x)
-    s = str(s).strip()
-    # 第二步：去除不可见字符和多余空格
-    s = CLEAN_PATTERN.sub('', s)
-    # 第三步：根据匹配模式处理
-    if match_mode == "loose":
-        s = ONLY_NUMBER_PATTERN.sub('', s)
-    return s
-
-# --------------------------
-# 2. 极速Excel读取，全量还原+号
-# --------------------------
 @st.cache_data(ttl=3600)
-def read_excel_cached(file_bytes, file_hash):
+def read_table_headers_cached(_file, file_hash, sheets):
     """
-    带缓存的Excel读取：
-    1. 只有文件变化时才重新读取，否则直接返回缓存结果
-    2. 读取后全量还原所有单元格的_x002B_为+号
-    3. 不修改任何其他正常内容，彻底解决0匹配问题
+    带缓存的表头扫描：上传后只读表头，马上就能选映射列；磁盘缓存里有就不碰文件
+    返回选中各工作表的表头 {工作表: 表头}，每个工作表按（文件hash, 工作表）单独落盘缓存
+    缓存只按文件hash和工作表区分（参数名前加_，Streamlit 不再对整个文件字节做第二次hash）
     """
     try:
-        # 读取Excel，强制所有列都是字符串，避免格式转换
-        df = pd.read_excel(BytesIO(file_bytes), dtype=str, keep_default_na=False)
-        df = df.fillna("")
-        # 全量还原+号，所有单元格都处理
-        df = df.map(restore_plus_sign)
-        return df
+        return load_headers(file_hash, _file.getvalue, list(sheets))
     except Exception as e:
         st.error(f"文件读取失败：{str(e)}")
         return None
 
+def read_table_columns_cached(requests):
+    """
+    多张表一起按列读取：requests = [(上传文件, 文件hash, {工作表: 表头}, 列名元组[第一列是主键列]), ...]
+    先查进程内共享存储：按列存放，key 是（文件hash, 工作表, 主键列, 列名），
+    别的会话读过同一个文件的某几列就直接共用那几列，映射不同的会话之间主键列和相同的映射列也只存一份；
+    （选了多个工作表时，没有主键列的工作表整个跳过，所以同一列在不同主键下的行不一样，主键列也算在 key 里）
+    没有的列再读：只解析选中的工作表，只有磁盘缓存没命中的列才解析，两个及以上的工作表要解析时放进进程池同时解析
+    返回（DataFrame 列表, 每张表在共享存储里的 key 元组列表）
+    """
+    table_keys = [
+        tuple(("column", file_hash, tuple(sheet_headers), columns[0], c) for c in columns)
+        for _, file_hash, sheet_headers, columns in requests
+    ]
+    sources = {keys[0][1:4]: request for keys, request in zip(table_keys, requests)}
+
+    def load(todo):
+        # 缺的列按（文件, 工作表, 主键列）归到一起，每张表只读一次
+        groups = {}
+        for k in todo:
+            groups.setdefault(k[1:4], []).append(k[4])
+        loaded = {}
+        group_list = list(groups.items())
+        dfs = load_sheets_columns_many([
+            (source[0], sources[source][0].getvalue, sources[source][2], tuple(dict.fromkeys([source[2], *missing])))
+            for source, missing in group_list
+        ])
+        for (source, missing), df in zip(group_list, dfs):
+            for c in missing:
+                loaded[("column", *source, c)] = df if isinstance(df, Exception) else df[c]
+        return [loaded[k] for k in todo]
+
+    all_keys = list(dict.fromkeys(k for keys in table_keys for k in keys))
+    columns = dict(zip(all_keys, SHARED_STORE.get_or_load_many(
+        all_keys, load, lambda s: int(s.memory_usage(deep=True, index=False)), st.session_state.store_owner.id,
+    )))
+    dfs = []
+    for (file, _, _, _), keys in zip(requests, table_keys):
+        error = next((columns[k] for k in keys if isinstance(columns[k], Exception)), None)
+        if error is not None:
+            st.error(f"{file.name} 读取失败：{str(error)}")
+            dfs.append(None)
+            continue
+        dfs.append(pd.DataFrame({k[4]: columns[k] for k in keys}))
+    return dfs, table_keys
+
+# 结果预览每页行数：只把当前页发给浏览器，几十万行的结果也不会卡住页面
+PREVIEW_PAGE_SIZE = 500
+
+def render_paged_dataframe(df, key, positions=None):
+    """分页显示表格，只取当前页的行；positions 给定时只在这些行号里翻页（不复制整表）"""
+    total = len(df) if positions is None else len(positions)
+    pages = max(1, -(-total // PREVIEW_PAGE_SIZE))
+    col_page, col_info = st.columns([1, 3])
+    with col_page:
+        page = st.number_input("页码", min_value=1, max_value=pages, value=1, step=1, key=key)
+    start = (page - 1) * PREVIEW_PAGE_SIZE
+    stop = min(start + PREVIEW_PAGE_SIZE, total)
+    with col_info:
+        st.write("")
+        st.caption(f"第 {start + 1}–{stop} 行，共 {total} 行 / {pages} 页（行号为结果表中的行号）")
+    window = df.iloc[start:stop] if positions is None else df.iloc[positions[start:stop]]
+    st.dataframe(window, use_container_width=True, height=400)
+
 # 生成文件唯一hash，用于缓存判断
 def get_file_hash(file):
-    """生成文件的MD5哈希，判断文件是否变化"""
+    """
+    生成文件指纹，判断文件是否变化：
+    同一次上传（上传组件的 file_id 不变）只计算一次，之后每次重跑直接查表，几乎零开销
+    """
     if file is None:
         return ""
-    file_bytes = file.getvalue()
-    return hashlib.md5(file_bytes).hexdigest()
+    return memo_file_hash(file, st.session_state.file_hash_memo, hash_file_profiled)
+
+def hash_file_profiled(file):
+    """真正需要计算指纹时才进入这里，计入性能剖析"""
+    with profiler.stage("hash", file=file.name, size_mb=round(file.size / 1024 / 1024, 2)):
+        return hash_file_content(file)
 
 # ===================== SessionState 初始化 =====================
+# 常用的订单号列名，上传后自动选为主键（表2优先识别线上订单号）
+DEFAULT_KEY_COLUMNS = ["订单编号", "线上订单号"]
+
+def guess_key_column(cols, slot):
+    """按常用列名猜主键列：表2优先「线上订单号」，其余优先「订单编号」，都没有就找带“订单号”的列"""
+    preferred = DEFAULT_KEY_COLUMNS[::-1] if slot == 2 else DEFAULT_KEY_COLUMNS
+    for name in preferred:
+        if name in cols:
+            return name
+    return next((c for c in cols if "订单号" in str(c)), cols[0])
+
+def new_table_state():
+    """单张表的全部状态：文件指纹、工作表、表头、主键、已读入的列、匹配索引、相似候选、人工配对、映射"""
+    return {
+        "hash": "",
+        # 上传的文件（存入历史库时取字节），换文件、清空时跟着换
+        "file": None,
+        # 文件格式（xlsx / xls / csv / tsv / parquet），按文件内容判断
+        "format": None,
+        "sheet_names": [],
+        "sheet_headers": {},
+        "cols": None,
+        "key": None,
+        "df": None,
+        "df_cols": (),
+        "index": None,
+        "ngram": {},
+        "suggestions": None,
+        "aliases": {"strict": {}, "loose": {}},
+        "mappings": [],
+        "match_count": 0,
+        # 在进程内共享存储里用的条目：{"table": key, "index": key}
+        "store_keys": {},
+    }
+
 def init_session_state():
+    # 本会话在共享存储里的身份，会话结束后自动释放在用的条目
+    if "store_owner" not in st.session_state:
+        st.session_state.store_owner = StoreOwner()
+    # 上传文件指纹缓存（file_id → 文件hash）
+    if "file_hash_memo" not in st.session_state:
+        st.session_state.file_hash_memo = {}
+    # 性能诊断开关（侧边栏切换，默认看环境变量 WMS_PROFILE）
+    if "profile_enabled" not in st.session_state:
+        st.session_state.profile_enabled = PROFILE_ENABLED
     # 全局匹配模式
     if "match_mode" not in st.session_state:
         st.session_state.match_mode = "strict"
@@ -135,26 +222,65 @@ def init_session_state():
         st.session_state.base_orders = []
     if "base_match_keys" not in st.session_state:
         st.session_state.base_match_keys = []
-    # 表1缓存
-    if "df1_hash" not in st.session_state:
-        st.session_state.df1_hash = ""
-    if "df1" not in st.session_state:
-        st.session_state.df1 = None
-    if "mappings1" not in st.session_state:
-        st.session_state.mappings1 = []
-    if "match1_count" not in st.session_state:
-        st.session_state.match1_count = 0
-    # 表2缓存
-    if "df2_hash" not in st.session_state:
-        st.session_state.df2_hash = ""
-    if "df2" not in st.session_state:
-        st.session_state.df2 = None
-    if "mappings2" not in st.session_state:
-        st.session_state.mappings2 = []
-    if "match2_count" not in st.session_state:
-        st.session_state.match2_count = 0
+        # 匹配键的 Arrow 索引（每张表的实时统计都直接查它，不用每次重跑都把列表重新转换一遍）
+        st.session_state.base_key_index = as_key_index([])
+        st.session_state.base_raw_count = 0
+        # 当前基准订单来自哪份输入：（输入内容的hash, 匹配模式），没变就不重新解析
+        st.session_state.base_source = None
+    # 各表缓存：表序号 → 单表状态，默认两张表，可以继续添加
+    if "tables" not in st.session_state:
+        st.session_state.tables = {1: new_table_state(), 2: new_table_state()}
+        st.session_state.table_slots = [1, 2]
+        st.session_state.next_table_slot = 3
 
 init_session_state()
+# 本次重跑的各阶段计时（诊断模式关闭时不记录）
+profiler = StageProfiler("rerun", st.session_state.profile_enabled)
+
+# ===================== 独立重跑区域 =====================
+# 基准订单、每张表、历史库、导出、结果预览各是一个 Streamlit fragment：区域里的操作（选列、增删映射、翻页……）
+# 只重跑这一块，其他表不重新统计、不重新渲染；影响到别的区域的变化（基准订单变了、换了文件）才整页重跑
+# 整页重跑到最后才置为 True。只重跑某个区域时，区域函数看到的是上一次整页重跑结束时的全局变量，也就是 True
+page_finished = False
+
+def rerun_page():
+    """整页重跑：只在区域单独重跑时需要（整页重跑的过程中本来就会往下跑到其他区域）"""
+    if page_finished:
+        st.rerun()
+
+def rerun_scope():
+    """重跑当前区域；整页重跑的过程中不能只重跑一块，就整页重跑"""
+    st.rerun(scope="fragment" if page_finished else "app")
+
+@contextmanager
+def scope_profiler(name):
+    """
+    整页重跑时，区域里的各阶段记到整页的记录里；
+    区域单独重跑时单独记一条（run 为「fragment:区域名」），写进诊断日志，侧边栏下次整页重跑时显示
+    """
+    global profiler
+    if not page_finished:
+        yield
+        return
+    page_profiler = profiler
+    profiler = StageProfiler(f"fragment:{name}", st.session_state.profile_enabled)
+    try:
+        yield
+    finally:
+        if profiler.enabled:
+            st.session_state.last_fragment_profile = profiler.record(match_mode=st.session_state.match_mode)
+            append_profile_log(st.session_state.last_fragment_profile)
+        profiler = page_profiler
+
+def page_fragment(name):
+    """把一个区域的渲染函数变成独立重跑区域"""
+    def decorate(fn):
+        @functools.wraps(fn)
+        def run(*args, **kwargs):
+            with scope_profiler(name):
+                return fn(*args, **kwargs)
+        return st.fragment(run)
+    return decorate
 
 # ===================== 侧边栏（新增匹配模式切换，解决0匹配）=====================
 with st.sidebar:
@@ -174,12 +300,24 @@ with st.sidebar:
     st.session_state.match_mode = "strict" if match_mode == "strict严格匹配" else "loose"
     st.markdown("---")
     st.markdown("#### 工具说明")
-    st.write("- 表1主键：**订单编号**")
-    st.write("- 表2主键：**线上订单号**")
+    st.write("- 表格数量不限，每张表单独选择主键列")
+    st.write("- 自动识别主键：**订单编号** / **线上订单号**")
     st.write("- 完美还原+号，无_x002B_转义")
     st.write("- 宽松匹配解决0匹配问题")
     st.markdown("---")
+    # 磁盘缓存状态（内容在页面最后渲染，统计才包含本次运行的读取）
+    disk_cache_panel = st.expander("💾 磁盘缓存", expanded=False)
+    # 进程内共享存储状态（所有会话共用）
+    shared_store_panel = st.expander("🧠 共享内存", expanded=False)
+    # 性能诊断：各阶段耗时、CPU、内存（内容同样在页面最后渲染）
+    diagnostics_panel = st.expander("⏱️ 性能诊断", expanded=False)
+    with diagnostics_panel:
+        st.checkbox("记录各阶段耗时和内存", key="profile_enabled", help=f"每次重跑和整合的记录追加写入 {PROFILE_LOG_PATH}")
+    st.markdown("---")
     if st.button("🔄 一键重置所有数据", type="secondary", use_container_width=True):
+        # 正在后台整合的先取消，结果不再需要
+        if st.session_state.get("job") is not None:
+            st.session_state.job.cancel()
         for key in list(st.session_state.keys()):
             del st.session_state[key]
         st.rerun()
@@ -187,368 +325,782 @@ with st.sidebar:
     st.caption("© 2026 0匹配修复版")
 
 # ===================== 主页面 =====================
-st.title("📦 双表订单整合工具 0匹配修复版")
+st.title("📦 多表订单整合工具 0匹配修复版")
 st.caption("✅ 完美还原+号 | ✅ 双匹配模式解决0匹配 | ✅ 大文件无卡顿 | ✅ 多列映射")
 
 # ===================== 步骤1：粘贴基准订单号 =====================
-st.markdown('<div class="step-card">', unsafe_allow_html=True)
-st.subheader("1️⃣ 粘贴基准订单号")
-order_input = st.text_area(
-    "每行一个订单号，带+号、横杠、字母均可自动识别",
-    height=140,
-    placeholder="260209-171976957502069\nABC+123456\n...",
-    key="order_input"
-)
+@page_fragment("base")
+def base_panel():
+    """基准订单区域：粘贴、上传订单号只重跑这一块，订单号真的变了才整页重跑"""
+    st.markdown('<div class="step-card">', unsafe_allow_html=True)
+    st.subheader("1️⃣ 粘贴基准订单号")
+    order_input = st.text_area(
+        "每行一个订单号，带+号、横杠、字母均可自动识别",
+        height=140,
+        placeholder="260209-171976957502069\nABC+123456\n...",
+        key="order_input"
+    )
+    # 几万、几十万个订单号建议上传文件：粘贴的大段文本每次操作都要在浏览器和服务端之间来回传
+    base_file = st.file_uploader(
+        "或者上传订单号文件（txt 每行一个；csv / tsv / xlsx / parquet 取「订单编号」列，没有就取第一列），上传后优先使用文件",
+        type=["txt", "csv", "tsv", "xlsx", "xls", "parquet"],
+        key="base_upload",
+    )
 
-# 解析订单号（仅当输入变化时重新计算）
-if order_input:
-    raw_list = [line.strip() for line in order_input.split("\n") if line.strip()]
-    # 自动去重，保留顺序
-    seen = set()
-    unique_orders = []
-    for order in raw_list:
-        cleaned = clean_order_id(order, st.session_state.match_mode)
-        if cleaned not in seen and cleaned != "":
-            seen.add(cleaned)
-            unique_orders.append(clean_order_id(order, "strict"))  # 原始订单号用严格模式保留完整内容
-    # 更新到session_state
-    st.session_state.base_orders = unique_orders
-    st.session_state.base_match_keys = [clean_order_id(o, st.session_state.match_mode) for o in unique_orders]
-    
-    # 统计信息
-    col1, col2, col3 = st.columns(3)
-    with col1:
-        st.metric("✅ 有效订单数", len(unique_orders))
-    with col2:
-        st.metric("🗑️ 自动去重数量", len(raw_list)-len(unique_orders))
-    with col3:
-        st.metric("🔑 当前匹配模式", st.session_state.match_mode)
+    # 解析订单号：只有输入内容或匹配模式变化时才重新解析，没变的重跑直接用上次的结果
+    if base_file is not None:
+        base_source = (get_file_hash(base_file), st.session_state.match_mode)
+    elif order_input:
+        base_source = (hash_file_content(BytesIO(order_input.encode("utf-8"))), st.session_state.match_mode)
+    else:
+        base_source = None
+    if base_source != st.session_state.base_source:
+        raw_lines = []
+        # 读取失败的提示存进会话：下面整页重跑后还要显示
+        st.session_state.base_error = None
+        try:
+            if base_file is not None:
+                with profiler.stage("base_file", file=base_file.name):
+                    raw_lines = base_order_lines(read_base_order_lines(base_file.getvalue(), base_file.name))
+            elif order_input:
+                raw_lines = base_order_lines(order_input.split("\n"))
+        except Exception as e:
+            st.session_state.base_error = f"订单号文件读取失败：{str(e)}"
+        with profiler.stage("base", rows=len(raw_lines)):
+            # 自动去重，保留顺序
+            unique_orders, base_match_keys = parse_base_orders(raw_lines, st.session_state.match_mode)
+        # 更新到session_state
+        st.session_state.base_orders = unique_orders
+        st.session_state.base_match_keys = base_match_keys
+        st.session_state.base_key_index = as_key_index(base_match_keys)
+        st.session_state.base_raw_count = len(raw_lines)
+        st.session_state.base_source = base_source
+        # 各表的匹配统计、历史库查询都依赖基准订单，只重跑这一块不够
+        rerun_page()
+    if st.session_state.get("base_error"):
+        st.error(st.session_state.base_error)
+
+    if st.session_state.base_orders:
+        unique_orders = st.session_state.base_orders
+        # 统计信息
+        col1, col2, col3 = st.columns(3)
+        with col1:
+            st.metric("✅ 有效订单数", len(unique_orders))
+        with col2:
+            st.metric("🗑️ 自动去重数量", st.session_state.base_raw_count-len(unique_orders))
+        with col3:
+            st.metric("🔑 当前匹配模式", st.session_state.match_mode)
     
-    # 直接显示匹配键，不用点展开，一眼看到问题
-    with st.expander("点击查看订单匹配键（核对用）", expanded=False):
-        st.markdown("| 原始订单号 | 匹配键（用于对比） |")
-        st.markdown("| --- | --- |")
-        for order, key in zip(unique_orders[:10], st.session_state.base_match_keys[:10]):
-            st.markdown(f"| `{order}` | `{key}` |")
-st.markdown('</div>', unsafe_allow_html=True)
+        # 直接显示匹配键，不用点展开，一眼看到问题
+        with st.expander("点击查看订单匹配键（核对用）", expanded=False):
+            st.markdown("| 原始订单号 | 匹配键（用于对比） |")
+            st.markdown("| --- | --- |")
+            for order, key in zip(unique_orders[:10], st.session_state.base_match_keys[:10]):
+                st.markdown(f"| `{order}` | `{key}` |")
+    st.markdown('</div>', unsafe_allow_html=True)
+
+base_panel()
 
-# ===================== 步骤2：双表上传+多列映射 =====================
+# ===================== 步骤2：多表上传+多列映射 =====================
 st.markdown("---")
-col_file1, col_file2 = st.columns(2)
-key1 = "订单编号"
-key2 = "线上订单号"
-
-# --------------------------
-# 表1：订单编号为主键
-# --------------------------
-with col_file1:
+
+def render_table_panel(slot):
+    """
+    渲染一张表的上传、主键选择和映射设置，状态都在 st.session_state.tables[slot] 里
+    数据列不在这里读：返回（上传文件, 需要的列, 匹配统计占位容器），由 table_panel 读完这张表的数据后再填匹配统计
+    没有上传文件时返回 None
+    """
+    table = st.session_state.tables[slot]
     st.markdown('<div class="step-card">', unsafe_allow_html=True)
-    st.subheader("📂 表1（主键：订单编号）")
-    file1 = st.file_uploader(
-        "上传表格，必须包含「订单编号」列",
-        type=["xlsx", "xls"],
-        key="file1_upload"
+    col_title, col_remove = st.columns([4, 1])
+    with col_title:
+        st.subheader(f"📂 表{slot}" + (f"（主键：{table['key']}）" if table["key"] else ""))
+    with col_remove:
+        if len(st.session_state.table_slots) > 1 and st.button("移除", key=f"remove_table{slot}", use_container_width=True):
+            st.session_state.table_slots.remove(slot)
+            del st.session_state.tables[slot]
+            st.rerun()
+    file = st.file_uploader(
+        "上传表格（Excel / CSV / TSV / Parquet），上传后选择订单号所在的主键列",
+        type=TABLE_UPLOAD_TYPES,
+        key=f"file{slot}_upload"
     )
 
-    # 极速读取：只有文件变化时才重新读取
-    current_hash1 = get_file_hash(file1)
-    if file1 and current_hash1 != st.session_state.df1_hash:
-        with st.spinner("正在读取文件（仅首次读取，后续秒开）..."):
-            df1 = read_excel_cached(file1.getvalue(), current_hash1)
-            if df1 is not None:
-                st.session_state.df1 = df1
-                st.session_state.df1_hash = current_hash1
-    else:
-        df1 = st.session_state.df1
-
-    # 处理表格逻辑
-    if df1 is not None:
-        # 校验主键
-        if key1 not in df1.columns:
-            st.error(f"❌ 未找到「{key1}」列！当前表格列名：{list(df1.columns)}")
-            st.session_state.df1 = None
+    # 极速读取：文件变化时只扫一遍表头，数据列按需读取
+    current_hash = get_file_hash(file)
+    if file and current_hash != table["hash"]:
+        with st.spinner("正在读取表头（仅首次读取，后续秒开）..."), profiler.stage("headers", table=f"表{slot}"):
+            # 只列出工作表名、读第一个工作表的表头，其他工作表选中时才读
+            sheet_names = read_sheet_names_cached(file, current_hash)
+            sheet_headers = read_table_headers_cached(file, current_hash, tuple(sheet_names[:1])) if sheet_names else None
+            if sheet_headers is not None:
+                cols = merge_sheet_headers(sheet_headers)
+                # 换了文件后，新表里没有的映射列自动移除，工作表选择恢复默认
+                mappings = [m for m in table["mappings"] if m[0] in cols]
+                # 判断格式只看文件开头
+                file.seek(0)
+                file_format = detect_table_format(file.read(TEXT_SNIFF_BYTES))
+                file.seek(0)
+                table.update(new_table_state(), hash=current_hash, file=file, format=file_format, sheet_names=sheet_names,
+                             sheet_headers=sheet_headers, cols=cols, mappings=mappings)
+                st.session_state.pop(f"sheets{slot}", None)
+                st.session_state.pop(f"all_sheets{slot}", None)
+                # 历史库区域要列出新文件的「存入历史库」按钮
+                rerun_page()
+
+    if not file or table["cols"] is None:
+        # 清空缓存；原来有文件的话历史库区域也要更新
+        had_file = table["file"] is not None
+        table.update(new_table_state())
+        if had_file:
+            rerun_page()
+        st.markdown('</div>', unsafe_allow_html=True)
+        return None
+
+    st.caption(f"格式：{TABLE_FORMAT_LABELS[table['format']]}")
+
+    # 多工作表（比如每个仓库一个工作表）：选一个或多个上下拼接，只解析选中的工作表
+    sheet_names = table["sheet_names"]
+    if len(sheet_names) > 1:
+        if st.checkbox(f"全部 {len(sheet_names)} 个工作表", key=f"all_sheets{slot}"):
+            sheets = sheet_names
         else:
-            st.success(f"✅ 已锁定主键：「{key1}」")
-            # 提前生成匹配键
-            df1["_match_key"] = df1[key1].apply(lambda x: clean_order_id(x, st.session_state.match_mode))
-            df1 = df1.drop_duplicates("_match_key", keep="first")
-            st.session_state.df1 = df1
-            
-            # 实时匹配统计
-            if st.session_state.base_match_keys:
-                table1_keys = df1["_match_key"].tolist()
-                match1_set = set(st.session_state.base_match_keys) & set(table1_keys)
-                match1_count = len(match1_set)
-                match1_rate = round(match1_count/len(st.session_state.base_match_keys)*100, 2) if len(st.session_state.base_match_keys) > 0 else 0
-                st.session_state.match1_count = match1_count
-                
-                col_a, col_b = st.columns(2)
-                with col_a:
-                    st.metric("✅ 匹配成功数", match1_count)
-                with col_b:
-                    st.metric("📊 匹配率", f"{match1_rate}%")
-                
-                # 匹配键对比，一眼看到问题
-                with st.expander("点击查看表1匹配键（核对用）", expanded=False):
-                    st.markdown("| 表格里的订单号 | 匹配键（用于对比） |")
-                    st.markdown("| --- | --- |")
-                    for o, k in zip(df1[key1][:10], df1["_match_key"][:10]):
-                        st.markdown(f"| `{o}` | `{k}` |")
-                
-                # 0匹配提示
-                if match1_count == 0:
-                    st.warning("⚠️ 无匹配订单，建议切换到「loose宽松匹配」模式，或核对两边的匹配键是否一致")
-            
-            # 多列映射设置
-            st.markdown("#### 🔗 多列映射设置")
-            select_cols1 = [c for c in df1.columns if c not in [key1, "_match_key"]]
-            if not select_cols1:
-                st.warning("⚠️ 无可用附加列")
-            else:
-                col_map1, col_map2, col_map3 = st.columns([2, 2, 1.2])
-                with col_map1:
-                    orig1 = st.selectbox("选择要提取的列", select_cols1, key="orig1")
-                with col_map2:
-                    new1 = st.text_input("设置导出新列名", value=orig1, key="new1")
-                with col_map3:
-                    st.write("")
-                    st.write("")
-                    add_btn1 = st.button("添加", key="add1", use_container_width=True)
-                
-                # 添加映射
-                if add_btn1:
-                    if not any(m[0] == orig1 for m in st.session_state.mappings1):
-                        st.session_state.mappings1.append((orig1, new1))
-                        st.toast(f"✅ 已添加：{orig1} → {new1}", icon="🎉")
-                    else:
-                        st.toast("⚠️ 该列已添加", icon="⚠️")
-                
-                # 显示已添加的映射
-                if st.session_state.mappings1:
-                    st.write("**✅ 已添加的映射：**")
-                    for i, (o, n) in enumerate(st.session_state.mappings1):
-                        col_d, col_e = st.columns([4, 1])
-                        with col_d:
-                            st.write(f"- `{o}` → `{n}`")
-                        with col_e:
-                            if st.button("删除", key=f"del1_{i}", use_container_width=True):
-                                del st.session_state.mappings1[i]
-                                st.rerun()
+            sheets = st.multiselect("工作表（可多选，上下拼接）", sheet_names, default=sheet_names[:1], key=f"sheets{slot}")
+        if not sheets:
+            st.warning("⚠️ 请至少选择一个工作表")
+            st.markdown('</div>', unsafe_allow_html=True)
+            return None
+        if list(sheets) != list(table["sheet_headers"]):
+            with profiler.stage("headers", table=f"表{slot}", sheets=len(sheets)):
+                sheet_headers = read_table_headers_cached(file, current_hash, tuple(sheets))
+            if sheet_headers is None:
+                st.markdown('</div>', unsafe_allow_html=True)
+                return None
+            # 换了工作表：数据行变了，匹配索引、相似候选、人工配对都要重建；选中的工作表里都没有的映射列自动移除
+            cols = merge_sheet_headers(sheet_headers)
+            table.update(
+                sheet_headers=sheet_headers, cols=cols, df=None, df_cols=(), index=None, ngram={}, suggestions=None,
+                aliases={"strict": {}, "loose": {}}, mappings=[m for m in table["mappings"] if m[0] in cols],
+                key=table["key"] if table["key"] in cols else None,
+            )
+    cols = table["cols"]
+
+    # 主键列：默认识别常用的订单号列名，可以手动改
+    default_key = table["key"] if table["key"] in cols else guess_key_column(cols, slot)
+    key = st.selectbox("主键列（订单号所在列）", cols, index=cols.index(default_key), key=f"key{slot}")
+    if key != table["key"]:
+        # 换了主键：匹配索引、相似候选、人工配对都要重建，主键列不能再作为映射列
+        table.update(
+            key=key, df=None, df_cols=(), index=None, ngram={}, suggestions=None,
+            aliases={"strict": {}, "loose": {}}, mappings=[m for m in table["mappings"] if m[0] != key],
+        )
+
+    # 匹配统计放在映射设置上方显示，但要等映射列确定、数据读完后再填充
+    stats_box = st.container()
+
+    # 多列映射设置（只依赖表头，不需要读数据）
+    st.markdown("#### 🔗 多列映射设置")
+    select_cols = [c for c in cols if c != key]
+    if not select_cols:
+        st.warning("⚠️ 无可用附加列")
     else:
-        # 清空缓存
-        st.session_state.df1 = None
-        st.session_state.mappings1 = []
-        st.session_state.match1_count = 0
-        st.session_state.df1_hash = ""
+        col_map1, col_map2, col_map3 = st.columns([2, 2, 1.2])
+        with col_map1:
+            orig = st.selectbox("选择要提取的列", select_cols, key=f"orig{slot}")
+        with col_map2:
+            new = st.text_input("设置导出新列名", value=orig, key=f"new{slot}")
+        with col_map3:
+            st.write("")
+            st.write("")
+            add_btn = st.button("添加", key=f"add{slot}", use_container_width=True)
+
+        # 添加映射
+        if add_btn:
+            if not any(m[0] == orig for m in table["mappings"]):
+                table["mappings"].append((orig, new))
+                st.toast(f"✅ 已添加：{orig} → {new}", icon="🎉")
+            else:
+                st.toast("⚠️ 该列已添加", icon="⚠️")
+
+        # 显示已添加的映射
+        if table["mappings"]:
+            st.write("**✅ 已添加的映射：**")
+            for i, (o, n) in enumerate(table["mappings"]):
+                col_d, col_e = st.columns([4, 1])
+                with col_d:
+                    st.write(f"- `{o}` → `{n}`")
+                with col_e:
+                    if st.button("删除", key=f"del{slot}_{i}", use_container_width=True):
+                        del table["mappings"][i]
+                        rerun_scope()
+
     st.markdown('</div>', unsafe_allow_html=True)
+    # 只读取主键列 + 已映射的列
+    return file, tuple([key] + [o for o, n in table["mappings"]]), stats_box
 
-# --------------------------
-# 表2：线上订单号为主键
-# --------------------------
-with col_file2:
-    st.markdown('<div class="step-card">', unsafe_allow_html=True)
-    st.subheader("📂 表2（主键：线上订单号）")
-    file2 = st.file_uploader(
-        "上传表格，必须包含「线上订单号」列",
-        type=["xlsx", "xls"],
-        key="file2_upload"
-    )
+def render_table_stats(slot, stats_box):
+    """数据读完后建匹配索引，并在面板上方的占位容器里填实时匹配统计"""
+    table = st.session_state.tables[slot]
+    df, key = table["df"], table["key"]
+    if df is not None and table["index"] is None:
+        # 匹配索引只在换文件/换主键时建一次（两种模式一起建），增删映射列、切换模式都不用重建
+        # 同一个文件、同样的工作表和主键列，别的会话建过的索引直接共用
+        index_key = ("index", table["hash"], tuple(table["sheet_headers"]), key)
+        with stats_box, st.spinner("正在建立匹配索引..."), profiler.stage("index", table=f"表{slot}", rows=len(df)):
+            table["index"] = SHARED_STORE.get_or_load_many(
+                [index_key], lambda todo: [build_match_index(df[key])], match_index_bytes, st.session_state.store_owner.id,
+            )[0]
+        table["store_keys"]["index"] = (index_key,)
 
-    # 极速读取：只有文件变化时才重新读取
-    current_hash2 = get_file_hash(file2)
-    if file2 and current_hash2 != st.session_state.df2_hash:
-        with st.spinner("正在读取文件（仅首次读取，后续秒开）..."):
-            df2 = read_excel_cached(file2.getvalue(), current_hash2)
-            if df2 is not None:
-                st.session_state.df2 = df2
-                st.session_state.df2_hash = current_hash2
-    else:
-        df2 = st.session_state.df2
-
-    # 处理表格逻辑
-    if df2 is not None:
-        # 校验主键
-        if key2 not in df2.columns:
-            st.error(f"❌ 未找到「{key2}」列！当前表格列名：{list(df2.columns)}")
-            st.session_state.df2 = None
+    # 会话里保存的这张表实际占用的内存（Arrow 字符串列 + 分类列）
+    if df is not None:
+        with stats_box:
+            size = table_memory_bytes(df)
+            size_text = f"{size / 1024 / 1024:.1f} MB" if size >= 1024 * 1024 else f"{size / 1024:.0f} KB"
+            st.caption(f"💾 已读入 {len(df)} 行 × {len(df.columns)} 列，占用内存 {size_text}")
+
+    # 实时匹配统计
+    if df is None or not st.session_state.base_match_keys:
+        return
+    mode = st.session_state.match_mode
+    with stats_box:
+        aliases = table["aliases"][mode]
+        with profiler.stage("match", table=f"表{slot}"):
+            positions = lookup_match_positions(table["index"], mode, st.session_state.base_key_index, aliases)
+        match_count = int((positions >= 0).sum())
+        match_rate = round(match_count/len(st.session_state.base_match_keys)*100, 2) if len(st.session_state.base_match_keys) > 0 else 0
+        table["match_count"] = match_count
+
+        col_a, col_b = st.columns(2)
+        with col_a:
+            st.metric("✅ 匹配成功数", match_count)
+        with col_b:
+            st.metric("📊 匹配率", f"{match_rate}%")
+
+        # 匹配键对比，一眼看到问题
+        with st.expander(f"点击查看表{slot}匹配键（核对用）", expanded=False):
+            st.markdown("| 表格里的订单号 | 匹配键（用于对比） |")
+            st.markdown("| --- | --- |")
+            for o, k in zip(restore_plus_sign_series(df[key][:10]), clean_order_ids(df[key][:10], mode)):
+                st.markdown(f"| `{o}` | `{k}` |")
+
+        # 表内重复主键提示（合并时取第一行）
+        # 主键为空的行（表中间的空行）不算重复
+        dup_counts = table["index"][mode]["dup_counts"]
+        dup_mask = (dup_counts > 1) & np.asarray(table["index"][mode]["keys"] != "")
+        dup_keys = int(dup_mask.sum())
+        if dup_keys > 0:
+            st.caption(f"ℹ️ 表内有 {dup_keys} 个重复主键（共 {int(dup_counts[dup_mask].sum())} 行），整合时取第一次出现的行")
+
+        # 0匹配提示
+        if match_count == 0:
+            st.warning("⚠️ 无匹配订单，建议切换到「loose宽松匹配」模式，或核对两边的匹配键是否一致")
+
+        # 未匹配订单的相似候选：不用切宽松模式（会丢字母和+号），逐条人工确认
+        unmatched = np.flatnonzero(positions < 0)
+        if len(unmatched) > 0:
+            with st.expander(f"🧩 未匹配订单的相似候选（{len(unmatched)} 个未匹配）", expanded=False):
+                st.caption("按编辑距离（含相邻数字互换）、相同前后缀查找表里最接近的订单号，勾选确认后整合时按确认的配对取数")
+                if st.button("🔍 查找相似订单", key=f"suggest{slot}"):
+                    entry = table["index"][mode]
+                    if mode not in table["ngram"]:
+                        with st.spinner("正在建立相似查找索引（仅首次）..."):
+                            table["ngram"][mode] = build_ngram_index(entry["keys"])
+                    query_keys = [st.session_state.base_match_keys[i] for i in unmatched]
+                    with st.spinner(f"正在为 {len(query_keys)} 个订单查找相似候选..."):
+                        found = suggest_similar_keys(table["ngram"][mode], entry["keys"], query_keys)
+                    base_pos = unmatched[found["query_pos"].to_numpy(dtype=np.int64)]
+                    key_pos = found["key_pos"].to_numpy(dtype=np.int64)
+                    table["suggestions"] = (mode, pd.DataFrame({
+                        "基准订单号": [st.session_state.base_orders[i] for i in base_pos],
+                        "表内订单号": restore_plus_sign_series(pd.Series(take_by_positions(df[key], entry["first_pos"][key_pos]))).to_numpy(),
+                        "编辑距离": found["distance"].to_numpy(),
+                        "相同前缀": found["shared_prefix"].to_numpy(),
+                        "相同后缀": found["shared_suffix"].to_numpy(),
+                        "确认": False,
+                        "基准匹配键": [st.session_state.base_match_keys[i] for i in base_pos],
+                        "表内匹配键": np.asarray(entry["keys"].take(key_pos), dtype=object),
+                    }))
+                suggestions = table["suggestions"]
+                if suggestions is not None and suggestions[0] == mode:
+                    if suggestions[1].empty:
+                        st.info("没有找到编辑距离3以内的相似订单")
+                    else:
+                        edited = st.data_editor(
+                            suggestions[1],
+                            key=f"suggest_editor{slot}",
+                            hide_index=True,
+                            use_container_width=True,
+                            disabled=[c for c in suggestions[1].columns if c != "确认"],
+                            column_config={"基准匹配键": None, "表内匹配键": None},
+                        )
+                        if st.button("✅ 应用勾选的配对", key=f"apply_suggest{slot}"):
+                            confirmed = edited[edited["确认"]]
+                            aliases.update(zip(confirmed["基准匹配键"], confirmed["表内匹配键"]))
+                            table["suggestions"] = None
+                            rerun_scope()
+
+        # 已确认的相似配对
+        if aliases:
+            col_f, col_g = st.columns([4, 1])
+            with col_f:
+                st.caption(f"🔗 已人工确认 {len(aliases)} 个相似配对，整合时按配对取数")
+            with col_g:
+                if st.button("清除配对", key=f"clear_aliases{slot}", use_container_width=True):
+                    aliases.clear()
+                    rerun_scope()
+
+def load_tables_data(requests):
+    """
+    读各表需要的列（主键列 + 映射列）：requests = [(表序号, 上传文件, 需要的列), ...]
+    删掉映射列时直接丢掉多余的列；映射列有变化的表放在一起读，只解析缓存里没有的列，两个及以上的工作表要解析时放进进程池同时解析
+    """
+    to_read = []
+    for slot, file, needed_cols in requests:
+        table = st.session_state.tables[slot]
+        if table["df"] is not None and table["df_cols"] != needed_cols and set(needed_cols) <= set(table["df_cols"]):
+            table["df"] = table["df"][list(needed_cols)]
+            table["df_cols"] = needed_cols
+            table["store_keys"]["table"] = tuple(k for k in table["store_keys"].get("table", ()) if k[4] in needed_cols)
+        if table["df"] is None or table["df_cols"] != needed_cols:
+            to_read.append((slot, file, needed_cols))
+    if not to_read:
+        return
+    tables = [st.session_state.tables[slot] for slot, _, _ in to_read]
+    formats = ",".join(dict.fromkeys(table["format"] for table in tables))
+    with st.spinner("正在读取表格数据..."), profiler.stage("parse", tables=len(to_read), formats=formats):
+        dfs, store_keys = read_table_columns_cached([
+            (file, table["hash"], table["sheet_headers"], needed_cols)
+            for (_, file, needed_cols), table in zip(to_read, tables)
+        ])
+    for (_, _, needed_cols), table, df, keys in zip(to_read, tables, dfs, store_keys):
+        table["df"] = df
+        table["df_cols"] = needed_cols if df is not None else ()
+        table["store_keys"]["table"] = keys
+
+def update_store_holds():
+    """登记本会话现在在用的共享条目：换了文件、换了列、移除了表，旧条目的引用随之释放，没有会话在用时才可能被淘汰"""
+    SHARED_STORE.set_holds(st.session_state.store_owner.id, [
+        store_key
+        for table in (st.session_state.tables[slot] for slot in st.session_state.table_slots)
+        for name, keys in table["store_keys"].items()
+        if table["df" if name == "table" else "index"] is not None
+        for store_key in keys
+    ])
+
+# 整页重跑时各表区域只渲染、登记要读的列，所有表渲染完再一起读取（多张表的解析同时进行），然后回填匹配统计；
+# 单独重跑一张表时就地读取这张表
+pending_tables = []
+
+@page_fragment("table")
+def table_panel(slot):
+    """一张表的独立重跑区域：选工作表、换主键、增删映射、查相似订单只重跑这张表，别的表不重新读取、不重新统计"""
+    panel = render_table_panel(slot)
+    if not page_finished:
+        if panel is not None:
+            pending_tables.append((slot, *panel))
+        return
+    if panel is not None:
+        file, needed_cols, stats_box = panel
+        load_tables_data([(slot, file, needed_cols)])
+        render_table_stats(slot, stats_box)
+    update_store_holds()
+
+# 每行两张表，数量不限（WMS、快递、财务、退货……）
+table_slots = list(st.session_state.table_slots)
+for row_start in range(0, len(table_slots), 2):
+    for col_file, slot in zip(st.columns(2), table_slots[row_start:row_start + 2]):
+        with col_file:
+            table_panel(slot)
+load_tables_data([(slot, file, needed_cols) for slot, file, needed_cols, _ in pending_tables])
+for slot, _, _, stats_box in pending_tables:
+    render_table_stats(slot, stats_box)
+update_store_holds()
+if st.button("➕ 添加表格", use_container_width=True):
+    slot = st.session_state.next_table_slot
+    st.session_state.next_table_slot += 1
+    st.session_state.table_slots.append(slot)
+    st.session_state.tables[slot] = new_table_state()
+    st.rerun()
+
+# ===================== 历史订单库：上传过的表存下来，以后不用再传 =====================
+def history_db_version():
+    """历史库文件的版本（大小、修改时间），存入或清空后就变"""
+    files = [HISTORY_DB_PATH + suffix for suffix in ("", "-wal")]
+    return tuple((os.path.getsize(f), os.path.getmtime(f)) if os.path.exists(f) else None for f in files)
+
+def get_history_stats():
+    """历史库概况，库文件没变化时直接用上次的结果，不每次重跑都数一遍订单"""
+    version = history_db_version()
+    memo = st.session_state.get("history_stats_memo")
+    if memo is None or memo[0] != version:
+        memo = (version, history_stats())
+        st.session_state.history_stats_memo = memo
+    return memo[1]
+
+@page_fragment("history")
+def history_panel():
+    """历史库区域：勾选取数、选列、存入、清空都只重跑这一块（整合时从会话状态里取勾选结果）"""
+    with st.expander("📚 历史订单库（存过的表以后不用再上传）", expanded=False):
+        history = get_history_stats()
+        if history is None or history["orders"] == 0:
+            st.caption("历史库还是空的：上传表格后点下面的按钮存进去，以后整合时直接按订单号查")
         else:
-            st.success(f"✅ 已锁定主键：「{key2}」")
-            # 提前生成匹配键
-            df2["_match_key"] = df2[key2].apply(lambda x: clean_order_id(x, st.session_state.match_mode))
-            df2 = df2.drop_duplicates("_match_key", keep="first")
-            st.session_state.df2 = df2
-            
-            # 实时匹配统计
-            if st.session_state.base_match_keys:
-                table2_keys = df2["_match_key"].tolist()
-                match2_set = set(st.session_state.base_match_keys) & set(table2_keys)
-                match2_count = len(match2_set)
-                match2_rate = round(match2_count/len(st.session_state.base_match_keys)*100, 2) if len(st.session_state.base_match_keys) > 0 else 0
-                st.session_state.match2_count = match2_count
-                
-                col_a, col_b = st.columns(2)
-                with col_a:
-                    st.metric("✅ 匹配成功数", match2_count)
-                with col_b:
-                    st.metric("📊 匹配率", f"{match2_rate}%")
-                
-                # 匹配键对比
-                with st.expander("点击查看表2匹配键（核对用）", expanded=False):
-                    st.markdown("| 表格里的订单号 | 匹配键（用于对比） |")
-                    st.markdown("| --- | --- |")
-                    for o, k in zip(df2[key2][:10], df2["_match_key"][:10]):
-                        st.markdown(f"| `{o}` | `{k}` |")
-                
-                # 0匹配提示
-                if match2_count == 0:
-                    st.warning("⚠️ 无匹配订单，建议切换到「loose宽松匹配」模式，或核对两边的匹配键是否一致")
-            
-            # 多列映射设置
-            st.markdown("#### 🔗 多列映射设置")
-            select_cols2 = [c for c in df2.columns if c not in [key2, "_match_key"]]
-            if not select_cols2:
-                st.warning("⚠️ 无可用附加列")
-            else:
-                col_map1, col_map2, col_map3 = st.columns([2, 2, 1.2])
-                with col_map1:
-                    orig2 = st.selectbox("选择要提取的列", select_cols2, key="orig2")
-                with col_map2:
-                    new2 = st.text_input("设置导出新列名", value=orig2, key="new2")
-                with col_map3:
-                    st.write("")
-                    st.write("")
-                    add_btn2 = st.button("添加", key="add2", use_container_width=True)
-                
-                # 添加映射
-                if add_btn2:
-                    if not any(m[0] == orig2 for m in st.session_state.mappings2):
-                        st.session_state.mappings2.append((orig2, new2))
-                        st.toast(f"✅ 已添加：{orig2} → {new2}", icon="🎉")
+            st.write(f"共 {history['orders']} 个订单，来自 {len(history['files'])} 份导入，库文件 {history['bytes'] / 1024 / 1024:.1f} MB")
+            st.dataframe(
+                pd.DataFrame(history["files"]).rename(columns={"name": "文件", "key": "主键列", "rows": "订单数", "imported_at": "导入时间"}),
+                hide_index=True, use_container_width=True,
+            )
+            st.checkbox("整合时也从历史库取数", key="use_history")
+            st.multiselect("从历史库取的列", history["columns"], key="history_columns")
+
+        # 已上传的表存进历史库：存所选工作表的全部列（同一份数据只存一次）
+        for slot in st.session_state.table_slots:
+            table = st.session_state.tables[slot]
+            file = table["file"]
+            if file is not None and table["key"] and st.button(f"💾 把表{slot}（{file.name}）存入历史库", key=f"ingest{slot}"):
+                with st.spinner(f"正在存入 {file.name} ..."), profiler.stage("ingest", table=f"表{slot}"):
+                    cols = tuple([table["key"]] + [c for c in table["cols"] if c != table["key"]])
+                    df = load_sheets_columns_many([(table["hash"], file.getvalue, table["sheet_headers"], cols)])[0]
+                    if isinstance(df, Exception):
+                        st.error(f"{file.name} 读取失败：{str(df)}")
                     else:
-                        st.toast("⚠️ 该列已添加", icon="⚠️")
-                
-                # 显示已添加的映射
-                if st.session_state.mappings2:
-                    st.write("**✅ 已添加的映射：**")
-                    for i, (o, n) in enumerate(st.session_state.mappings2):
-                        col_d, col_e = st.columns([4, 1])
-                        with col_d:
-                            st.write(f"- `{o}` → `{n}`")
-                        with col_e:
-                            if st.button("删除", key=f"del2_{i}", use_container_width=True):
-                                del st.session_state.mappings2[i]
-                                st.rerun()
-    else:
-        # 清空缓存
-        st.session_state.df2 = None
-        st.session_state.mappings2 = []
-        st.session_state.match2_count = 0
-        st.session_state.df2_hash = ""
-    st.markdown('</div>', unsafe_allow_html=True)
+                        count = history_ingest(df, table["key"], table["hash"], file.name, tuple(table["sheet_headers"]))
+                        if count is None:
+                            st.info(f"{file.name} 已经存过了")
+                        else:
+                            st.success(f"✅ 已存入 {count} 个订单")
+
+        if history is not None and st.button("🗑️ 清空历史库", key="clear_history"):
+            history_clear()
+            st.session_state.pop("history_stats_memo", None)
+            rerun_scope()
+
+if HISTORY_ENABLED:
+    history_panel()
 
 # ===================== 步骤3：执行整合+导出 =====================
 st.markdown('<div class="step-card">', unsafe_allow_html=True)
 st.subheader("3️⃣ 执行整合并导出")
-col_name, col_btn = st.columns([3, 2])
-with col_name:
-    export_name = st.text_input("导出文件名", value="订单整合结果")
-with col_btn:
-    st.write("")
-    st.write("")
-    run_btn = st.button("🚀 执行整合", type="primary", use_container_width=True)
-
-# 执行逻辑
-if run_btn:
+
+# 后台整合任务的各阶段在进度条上的说明
+JOB_STAGE_LABELS = {"start": "正在准备", "history": "正在查询历史库", "merge": "正在合并各表数据", "export": "正在生成导出文件"}
+
+def start_integration_job(tables, history_columns, export_name, export_fmt, fingerprint):
+    """
+    把整合交给后台线程：只带走本次要用的数据（后台线程里不能读写会话状态），页面照常可以操作
+    这里只合并不导出，导出文件等点下载时再按格式生成
+    """
+    base_orders = st.session_state.base_orders
+    base_keys = st.session_state.base_key_index
+    match_mode = st.session_state.match_mode
+    run_profiler = StageProfiler("integrate", st.session_state.profile_enabled)
+
+    def integrate(job):
+        # 所有表一次性按匹配索引对齐到基准订单顺序；未匹配订单直接由各表的匹配标记求出，不扫描结果表
+        result = run_integration(base_orders, base_keys, match_mode, tables, None, history_columns=history_columns,
+                                 progress=job.report, profiler=run_profiler)
+        profile = None
+        if run_profiler.enabled:
+            profile = run_profiler.record(rows=len(result["df"]), tables=result["tables"], match_mode=match_mode)
+            append_profile_log(profile)
+        return {
+            "df": result["df"],
+            "match_counts": {name: int(flags.sum()) for name, flags in result["matched"].items()},
+            "unmatched": result["unmatched"],
+            "fingerprint": fingerprint,
+            "file_stem": export_name,
+            "fmt": export_fmt,
+            # 已经生成过的导出文件：格式 → 字节
+            "exports": {},
+            "profile": profile,
+        }
+
+    st.session_state.job = BackgroundJob(integrate)
+
+@st.fragment(run_every=0.5)
+def render_job_progress():
+    """后台整合 / 导出进行中：只有这一块定时刷新（显示进度、取消按钮），结束后整页重跑一次展示结果"""
+    job = st.session_state.get("job")
+    if job is None:
+        return
+    snap = job.snapshot()
+    if job.running:
+        stage = JOB_STAGE_LABELS.get(snap["stage"], snap["stage"])
+        if snap["total"]:
+            unit = "行" if snap["stage"] == "export" else "列"
+            text = f"{stage}：{snap['done']:,} / {snap['total']:,} {unit}"
+            value = snap["done"] / snap["total"]
+        else:
+            text, value = f"{stage}...", 0.0
+        if snap["eta_s"] is not None:
+            text += f"，预计还要 {snap['eta_s']:.0f} 秒"
+        if snap["cancelling"]:
+            text = "正在取消..."
+        st.progress(min(value, 1.0), text=text)
+        st.caption(f"已用时 {snap['elapsed_s']:.1f} 秒，{job.name}在后台进行，页面可以继续操作")
+        st.button(f"⏹️ 取消{job.name}", on_click=job.cancel, disabled=snap["cancelling"], use_container_width=True)
+        return
+    # 结束：结果存进会话，翻页、展开未匹配列表等操作重跑页面时不用重新整合（导出任务已经把文件存进了结果）
+    st.session_state.job = None
+    if job.status == "done" and job.name == "整合":
+        result = dict(job.result)
+        profile = result.pop("profile")
+        if profile is not None:
+            st.session_state.last_run_profile = profile
+        st.session_state.result = result
+        # 新结果从第一页开始看
+        st.session_state.pop("preview_page", None)
+        st.session_state.pop("unmatched_page", None)
+    st.session_state.job_notice = (job.name, job.status, job.error)
+    st.rerun()
+
+@page_fragment("export")
+def export_panel():
+    """导出设置和执行按钮：改文件名、换格式只重跑这一块；开始整合后整页重跑一次，显示进度条"""
+    col_name, col_fmt, col_btn = st.columns([3, 2, 2])
+    with col_name:
+        export_name = st.text_input("导出文件名", value="订单整合结果")
+    with col_fmt:
+        export_fmt = st.selectbox(
+            "导出格式", list(EXPORT_FORMATS), format_func=lambda f: EXPORT_FORMATS[f][0],
+            help="整合后三种格式都可以下载，这里选的格式排在最前面；Excel 超过 1,048,576 行会自动拆成多个工作表",
+        )
+    with col_btn:
+        st.write("")
+        st.write("")
+        # 后台整合进行中不能再点，先等它完成或取消
+        run_btn = st.button("🚀 执行整合", type="primary", use_container_width=True,
+                            disabled=st.session_state.get("job") is not None)
+    if not run_btn:
+        return
+    use_history = HISTORY_ENABLED and st.session_state.get("use_history", False) and bool(st.session_state.get("history_columns"))
     # 基础校验
     if not st.session_state.base_orders:
         st.error("❌ 请先粘贴基准订单号！")
-    elif st.session_state.df1 is None and st.session_state.df2 is None:
+    elif not use_history and all(st.session_state.tables[slot]["df"] is None for slot in st.session_state.table_slots):
         st.error("❌ 请至少上传一个有效表格！")
-    elif len(st.session_state.mappings1) == 0 and len(st.session_state.mappings2) == 0:
+    elif not use_history and all(len(st.session_state.tables[slot]["mappings"]) == 0 for slot in st.session_state.table_slots):
         st.error("❌ 请至少添加一个列映射！")
     else:
-        try:
-            # 进度条
-            progress_bar = st.progress(0, text="正在初始化...")
-            total_step = 5
-
-            # 步骤1：创建基准表
-            progress_bar.progress(1/total_step, text="✅ 基准表初始化完成")
-            base_df = pd.DataFrame({"订单编号": st.session_state.base_orders})
-            base_df["_match_key"] = st.session_state.base_match_keys
-
-            # 步骤2：合并表1
-            if st.session_state.df1 is not None and len(st.session_state.mappings1) > 0:
-                progress_bar.progress(2/total_step, text="✅ 表1数据合并完成")
-                df1 = st.session_state.df1
-                needed_cols1 = ["_match_key"] + [o for o, n in st.session_state.mappings1]
-                temp1 = df1[needed_cols1].copy()
-                temp1 = temp1.rename(columns={o: n for o, n in st.session_state.mappings1})
-                base_df = pd.merge(base_df, temp1, on="_match_key", how="left")
-
-            # 步骤3：合并表2
-            if st.session_state.df2 is not None and len(st.session_state.mappings2) > 0:
-                progress_bar.progress(3/total_step, text="✅ 表2数据合并完成")
-                df2 = st.session_state.df2
-                needed_cols2 = ["_match_key"] + [o for o, n in st.session_state.mappings2]
-                temp2 = df2[needed_cols2].copy()
-                temp2 = temp2.rename(columns={o: n for o, n in st.session_state.mappings2})
-                base_df = pd.merge(base_df, temp2, on="_match_key", how="left")
-
-            # 步骤4：数据清理
-            progress_bar.progress(4/total_step, text="✅ 数据清理完成，正在生成导出文件")
-            final_df = base_df.drop(columns=["_match_key"]).fillna("")
-            final_df = final_df.loc[:, ~final_df.columns.duplicated()]
-
-            # 步骤5：生成导出文件
-            output = BytesIO()
-            with pd.ExcelWriter(output, engine="xlsxwriter") as writer:
-                final_df.to_excel(writer, index=False, sheet_name="整合结果")
-                # 自动调整列宽
-                ws = writer.sheets["整合结果"]
-                ws.set_column("A:A", 28)
-                for idx in range(1, len(final_df.columns)):
-                    ws.set_column(idx, idx, 22)
-            output.seek(0)
-
-            # 完成
-            progress_bar.progress(5/total_step, text="🎉 全部完成！")
+        # 只带真正参与整合的表（数据和索引都读好了、有映射）：指纹也只按这些表算，
+        # 某张表这次没读出来时的结果，不会在它读好之后被当成同一份结果复用
+        tables = [
+            {"name": f"表{slot}", "df": table["df"], "index": table["index"], "mappings": list(table["mappings"]),
+             "aliases": table["aliases"][st.session_state.match_mode],
+             "source": (table["hash"], list(table["sheet_headers"]), table["key"])}
+            for slot, table in ((slot, st.session_state.tables[slot]) for slot in st.session_state.table_slots)
+            if table["df"] is not None and table["index"] is not None and table["mappings"]
+        ]
+        # 历史库：按基准匹配键查出匹配到的订单，当成一张普通的表参与整合
+        history_columns = list(st.session_state.history_columns) if use_history else None
+        fingerprint = integration_fingerprint(
+            st.session_state.base_source, st.session_state.match_mode, tables,
+            (history_columns, history_db_version()) if history_columns else None,
+        )
+        result = st.session_state.get("result")
+        if result is not None and result["fingerprint"] == fingerprint:
+            # 输入都没变：直接用上次的结果，只换文件名和首选格式，已经生成过的导出文件也接着用
+            result.update(file_stem=export_name, fmt=export_fmt)
+            st.session_state.job_notice = ("整合", "reused", None)
+        else:
+            start_integration_job(tables, history_columns, export_name, export_fmt, fingerprint)
+        # 进度条、结果都在区域外面，整页重跑才显示出来
+        rerun_page()
+
+export_panel()
+
+if st.session_state.get("job") is not None:
+    render_job_progress()
+
+# 上一次后台整合 / 导出的结束提示（只显示一次）
+job_notice = st.session_state.pop("job_notice", None)
+if job_notice is not None:
+    name, status, error = job_notice
+    if status == "done":
+        if name == "整合":
             st.balloons()
+        else:
+            st.success("✅ 导出文件已生成，点下面的下载按钮保存")
+    elif status == "reused":
+        st.info("ℹ️ 基准订单、表格和映射都没变，直接使用上次的整合结果")
+    elif status == "cancelled":
+        st.warning(f"⏹️ {name}已取消")
+    else:
+        st.error(f"❌ {name}失败：{str(error)}")
+        st.code(f"错误详情：{repr(error)}")
+
+# 结果超过这么多个单元格（行数 × 列数）时，这个格式的文件放到后台生成：显示进度和剩余时间、可以取消，生成好再下载；
+# 没超过的点下载时当场生成（大约 1~2 秒以内）
+EXPORT_BACKGROUND_CELLS = {"xlsx": 1_000_000, "csv": 10_000_000, "parquet": 20_000_000}
+
+def build_export(result, fmt, profile_enabled, progress=None):
+    """生成一个格式的导出文件，存进结果里（同一份结果同一格式只生成一次），返回字节"""
+    data = result["exports"].get(fmt)
+    if data is None:
+        export_profiler = StageProfiler("export", profile_enabled)
+        output = BytesIO()
+        with export_profiler.stage("export", format=fmt):
+            export_result(result["df"], output, fmt, progress)
+        data = result["exports"][fmt] = output.getvalue()
+        if export_profiler.enabled:
+            append_profile_log(export_profiler.record(rows=len(result["df"]), output_mb=round(len(data) / 1024 / 1024, 2)))
+    return data
+
+def export_download(result, fmt):
+    """下载按钮的数据：点下载时才生成（Streamlit 在单独的线程里调用，不阻塞页面），生成过的直接给字节"""
+    profile_enabled = st.session_state.profile_enabled
+    return lambda: build_export(result, fmt, profile_enabled)
+
+def start_export_job(result, fmt):
+    """大结果的导出交给后台线程：和整合共用进度条（已写出的行数、剩余时间）和取消按钮"""
+    profile_enabled = st.session_state.profile_enabled
+
+    def export(job):
+        build_export(result, fmt, profile_enabled, progress=job.report)
+        return None
+
+    st.session_state.job = BackgroundJob(export, name="导出")
+
+# 结果展示（最近一次整合的结果）
+@page_fragment("result")
+def result_panel():
+    """结果区域：翻页、展开未匹配列表、下载只重跑这一块"""
+    result = st.session_state.get("result")
+    if result is None:
+        return
+    final_df = result["df"]
+    unmatched = result["unmatched"]
+    st.success(f"✅ 整合完成！共 {len(final_df)} 行，{len(final_df.columns)-1} 个字段，+号已完美还原")
+    sheet_count = excel_sheet_count(len(final_df))
+    if sheet_count > 1:
+        st.info(f"ℹ️ 结果超过 Excel 单表行数上限，下载 Excel 时会拆成 {sheet_count} 个工作表（整合结果、整合结果2……）")
+    stat_cols = st.columns(len(result["match_counts"]) + 1)
+    for col_stat, (name, count) in zip(stat_cols, result["match_counts"].items()):
+        with col_stat:
+            st.metric(f"{name}匹配成功", f"{count} 条")
+    with stat_cols[-1]:
+        st.metric("总字段数", len(final_df.columns)-1)
+
+    # 结果表格：分页预览，浏览器只收到当前页
+    render_paged_dataframe(final_df, "preview_page")
 
-            # 结果展示
-            st.success(f"✅ 整合完成！共 {len(final_df)} 行，{len(final_df.columns)-1} 个字段，+号已完美还原")
-            col_stat1, col_stat2, col_stat3 = st.columns(3)
-            with col_stat1:
-                st.metric("表1匹配成功", f"{st.session_state.match1_count} 条")
-            with col_stat2:
-                st.metric("表2匹配成功", f"{st.session_state.match2_count} 条")
-            with col_stat3:
-                st.metric("总字段数", len(final_df.columns)-1)
-
-            # 结果表格
-            st.dataframe(final_df, use_container_width=True, height=400)
-
-            # 未匹配订单
-            with st.expander("🔍 查看未匹配到任何数据的订单"):
-                no_match_df = final_df[final_df.drop(columns=["订单编号"]).eq("").all(axis=1)]
-                if len(no_match_df) > 0:
-                    st.warning(f"共 {len(no_match_df)} 个订单未匹配到数据")
-                    st.dataframe(no_match_df[["订单编号"]], use_container_width=True)
-                    st.code("\n".join(no_match_df["订单编号"].tolist()), language="text")
-                else:
-                    st.success("🎉 所有订单都匹配到了数据！")
-
-            # 下载按钮
+    # 未匹配订单
+    with st.expander("🔍 查看未匹配到任何数据的订单"):
+        if len(unmatched) > 0:
+            st.warning(f"共 {len(unmatched)} 个订单未匹配到数据")
+            render_paged_dataframe(final_df[[BASE_ORDER_COLUMN]], "unmatched_page", unmatched)
+            unmatched_orders = final_df[BASE_ORDER_COLUMN].take(unmatched)
+            if len(unmatched) <= PREVIEW_PAGE_SIZE:
+                st.code("\n".join(unmatched_orders.tolist()), language="text")
             st.download_button(
-                label="📥 下载Excel结果",
-                data=output,
-                file_name=f"{export_name}.xlsx",
-                mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-                use_container_width=True,
-                type="primary"
+                label="📄 下载未匹配订单号（txt）",
+                data=lambda: "\n".join(unmatched_orders.tolist()).encode("utf-8"),
+                file_name=f"{result['file_stem']}_未匹配.txt",
+                mime="text/plain",
+                on_click="ignore",
             )
+        else:
+            st.success("🎉 所有订单都匹配到了数据！")
 
-        except Exception as e:
-            st.error(f"❌ 整合失败：{str(e)}")
-            st.code(f"错误详情：{repr(e)}")
+    # 下载按钮：每种格式一个，选定的格式排最前；点了才生成文件，下载不重跑页面
+    # 大结果先点「生成」在后台生成（有进度、可取消），生成好了再下载
+    formats = [result["fmt"]] + [fmt for fmt in EXPORT_FORMATS if fmt != result["fmt"]]
+    cells = len(final_df) * len(final_df.columns)
+    for col_download, fmt in zip(st.columns(len(formats)), formats):
+        with col_download:
+            if fmt not in result["exports"] and cells > EXPORT_BACKGROUND_CELLS[fmt]:
+                if st.button(f"⚙️ 生成{EXPORT_FORMATS[fmt][0]}文件", key=f"prepare_{fmt}", use_container_width=True,
+                             type="primary" if fmt == result["fmt"] else "secondary",
+                             disabled=st.session_state.get("job") is not None):
+                    start_export_job(result, fmt)
+                    # 进度条在区域外面，整页重跑才显示出来
+                    rerun_page()
+                continue
+            st.download_button(
+                label=f"📥 下载{EXPORT_FORMATS[fmt][0]}结果",
+                data=export_download(result, fmt),
+                file_name=f"{result['file_stem']}.{fmt}",
+                mime=EXPORT_FORMATS[fmt][1],
+                on_click="ignore",
+                use_container_width=True,
+                type="primary" if fmt == result["fmt"] else "secondary",
+                key=f"download_{fmt}",
+            )
+result_panel()
 st.markdown('</div>', unsafe_allow_html=True)
+
+# ===================== 侧边栏：磁盘缓存状态 =====================
+with disk_cache_panel:
+    if DISK_CACHE_MAX_BYTES <= 0:
+        st.caption("磁盘缓存已关闭（WMS_CACHE_MAX_MB=0）")
+    else:
+        cache_stats = get_disk_cache_stats()
+        cache_entries, cache_bytes = disk_cache_usage()
+        cache_total = cache_stats["hits"] + cache_stats["misses"]
+        st.write(f"- 已用：{cache_bytes / 1024 / 1024:.1f} MB / {DISK_CACHE_MAX_BYTES / 1024 / 1024:.0f} MB（{len(cache_entries)} 个文件）")
+        st.write(f"- 命中：{cache_stats['hits']} 次，未命中：{cache_stats['misses']} 次，命中率 {cache_stats['hits'] / cache_total * 100 if cache_total else 0:.1f}%")
+        st.write(f"- 淘汰：{cache_stats['evictions']} 个文件")
+        if cache_stats["write_errors"]:
+            st.write(f"- 写入失败：{cache_stats['write_errors']} 次（不影响读取结果）")
+        if st.button("🧹 清空磁盘缓存", use_container_width=True):
+            disk_cache_clear()
+            st.rerun()
+
+# ===================== 侧边栏：共享内存状态 =====================
+with shared_store_panel:
+    store_usage = SHARED_STORE.usage()
+    store_total = store_usage["hits"] + store_usage["misses"]
+    st.write(f"- 常驻：{store_usage['bytes'] / 1024 / 1024:.1f} MB / {SHARED_STORE.max_bytes / 1024 / 1024:.0f} MB（{store_usage['entries']} 份列和索引）")
+    st.write(f"- 在用：{store_usage['in_use']} 份，{store_usage['in_use_bytes'] / 1024 / 1024:.1f} MB，{store_usage['owners']} 个会话")
+    st.write(f"- 命中：{store_usage['hits']} 次，未命中：{store_usage['misses']} 次，命中率 {store_usage['hits'] / store_total * 100 if store_total else 0:.1f}%")
+    st.write(f"- 淘汰：{store_usage['evictions']} 份")
+    if st.button("🧹 释放没人在用的数据", use_container_width=True):
+        SHARED_STORE.clear_unused()
+        st.rerun()
+
+# ===================== 侧边栏：性能诊断 =====================
+def render_profile(record):
+    """一次运行的各阶段明细表 + 汇总"""
+    st.caption(
+        f"共 {record['wall_s']:.3f} 秒，CPU {record['cpu_s']:.3f} 秒"
+        + (f"，内存 {record['mem_delta_mb']:+.1f} MB（当前 {record['rss_mb']:.0f} MB）" if record["rss_mb"] is not None else "")
+    )
+    if record["stages"]:
+        st.dataframe(pd.DataFrame(record["stages"]), hide_index=True, use_container_width=True)
+
+if profiler.enabled:
+    # 先写日志再渲染面板，面板本身的渲染不计入本次重跑
+    rerun_record = profiler.record(
+        tables=len(st.session_state.table_slots), base_orders=len(st.session_state.base_orders),
+        match_mode=st.session_state.match_mode,
+    )
+    log_ok = append_profile_log(rerun_record)
+    with diagnostics_panel:
+        st.markdown("**本次重跑**")
+        render_profile(rerun_record)
+        last_run = st.session_state.get("last_run_profile")
+        if last_run is not None:
+            st.markdown(f"**最近一次整合**（{last_run['time']}，{last_run['rows']} 行）")
+            render_profile(last_run)
+        last_fragment = st.session_state.get("last_fragment_profile")
+        if last_fragment is not None:
+            st.markdown(f"**最近一次局部重跑**（{last_fragment['run'].split(':', 1)[1]}，{last_fragment['time']}）")
+            render_profile(last_fragment)
+        if not log_ok:
+            st.warning(f"诊断日志写入失败：{PROFILE_LOG_PATH}")
+        if st.button("📈 汇总历史耗时分位数", use_container_width=True):
+            summary = summarize_profile_log()
+            if summary.empty:
+                st.caption("日志里还没有记录")
+            else:
+                st.dataframe(summary, hide_index=True, use_container_width=True)
+# 各格式的解析耗时（本服务进程累计，磁盘缓存命中的不算），方便对比 Excel 和 CSV / Parquet
+load_stats = get_load_stats()
+if load_stats:
+    with diagnostics_panel:
+        st.markdown("**各格式解析耗时**（本进程累计）")
+        st.dataframe(pd.DataFrame(load_stats), hide_index=True, use_container_width=True)
+
+# 整页重跑到这里才算完，之后各区域单独重跑时按区域记录、按区域重跑
+page_finished = True
@@ -0,0 +1,163 @@
+"""
+订单整合命令行（无界面批量模式，适合定时任务 / 夜间批量跑门店文件）
+
+单个任务：
+    python wms_cli.py --base 订单号.txt \
+        --table 表1.xlsx 订单编号 金额 状态=订单状态 \
+        --table 表2.xlsx 线上订单号 快递单号 \
+        -o 整合结果.xlsx
+
+多工作表的文件在文件名后面加「@工作表名」选择工作表，多个用逗号分隔，@all 表示全部（上下拼接），默认第一个：
+    python wms_cli.py --base 订单号.txt --table 月报.xlsx@仓A,仓B 订单编号 金额 来源工作表 -o 整合结果.xlsx
+
+表格除了 xlsx / xls，也可以是 CSV / TSV（UTF-8 或 GBK 自动识别）和 Parquet，按文件内容判断格式，解析比 xlsx 快得多：
+    python wms_cli.py --base 订单号.txt --table WMS导出.csv 订单编号 金额 --table 数据组.parquet 订单编号 成本 -o 整合结果.xlsx
+
+导出格式按 -o 的扩展名判断（.xlsx / .csv / .parquet），也可以用 --format 指定；
+xlsx 超过 Excel 行数上限时自动拆成多个工作表
+
+历史订单库：先把表格存进去（全部列，同一份数据只存一次），以后整合用 --history 直接按订单号查，不用再传表格：
+    python wms_cli.py --ingest 一月.xlsx 订单编号 --ingest 二月.xlsx@all 订单编号
+    python wms_cli.py --base 订单号.txt --history 金额 状态 -o 整合结果.xlsx
+
+批量任务（多进程并行）：
+    python wms_cli.py --jobs jobs.json --workers 4
+
+jobs.json 是任务列表，每个任务的格式见 wms_core.run_job，相对路径按 jobs.json 所在目录解析：
+    [{"base": "订单号.txt", "tables": [{"path": "门店A.xlsx", "key": "订单编号", "mappings": [["金额", "金额"]]}],
+      "output": "结果/门店A.xlsx", "match_mode": "strict"}]
+"""
+import argparse
+import json
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import wms_core
+from wms_core import EXPORT_FORMATS, run_job
+
+
+def parse_mapping(token):
+    """「原列=新列」或只写「原列」（导出列名不变）"""
+    orig, _, new = token.partition("=")
+    return [orig, new or orig]
+
+
+def parse_table_path(token):
+    """「文件@工作表1,工作表2」拆成（文件, 工作表）；文件名本身带 @ 且文件存在时不拆"""
+    path, sep, sheets = token.rpartition("@")
+    if not sep or os.path.exists(token):
+        return token, None
+    return path, "all" if sheets == "all" else sheets.split(",")
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="订单整合命令行：基准订单号 + 多个表格按映射取列，导出 xlsx")
+    parser.add_argument("--base", help="基准订单号文件：txt 每行一个，或 csv / xlsx（取订单编号列，没有就取第一列）")
+    parser.add_argument(
+        "--table", action="append", nargs="+", default=[], metavar="ARG",
+        help="表格文件[@工作表] 主键列 映射列...，映射列写成「原列=新列」或「原列」，可重复指定多个表",
+    )
+    parser.add_argument(
+        "--history", nargs="+", metavar="列", help="同时从历史订单库取这些列（历史库当成一张表参与整合）",
+    )
+    parser.add_argument(
+        "--ingest", action="append", nargs=2, default=[], metavar=("文件[@工作表]", "主键列"),
+        help="把表格存进历史订单库，可重复指定；只导入时不需要 --base / -o",
+    )
+    parser.add_argument("-o", "--output", help="导出文件路径（.xlsx / .csv / .parquet）")
+    parser.add_argument("--format", choices=list(EXPORT_FORMATS), help="导出格式（默认按 -o 的扩展名判断）")
+    parser.add_argument("--mode", choices=["strict", "loose"], default="strict", help="匹配模式（默认 strict）")
+    parser.add_argument("--jobs", help="批量任务 JSON 文件")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="批量任务并行进程数")
+    return parser
+
+
+def resolve_job_paths(job, root):
+    """把任务里的相对路径解析成相对 jobs.json 所在目录"""
+    def resolve(p):
+        return p if os.path.isabs(p) else os.path.join(root, p)
+    job = dict(job)
+    job["base"] = resolve(job["base"])
+    job["output"] = resolve(job["output"])
+    job["tables"] = [dict(t, path=resolve(t["path"])) for t in job.get("tables", [])]
+    return job
+
+
+def load_jobs(args, parser):
+    if args.jobs:
+        with open(args.jobs, encoding="utf-8") as f:
+            jobs = json.load(f)
+        if isinstance(jobs, dict):
+            jobs = jobs.get("jobs", [])
+        root = os.path.dirname(os.path.abspath(args.jobs))
+        return [resolve_job_paths(job, root) for job in jobs]
+    if not args.base or not (args.table or args.history) or not args.output:
+        parser.error("单个任务需要同时指定 --base、--table（或 --history）和 --output（或者用 --jobs 批量运行）")
+    tables = []
+    for spec in args.table:
+        if len(spec) < 2:
+            parser.error(f"--table 至少需要「文件 主键列」两个参数：{spec}")
+        path, sheets = parse_table_path(spec[0])
+        tables.append({"path": path, "sheets": sheets, "key": spec[1], "mappings": [parse_mapping(t) for t in spec[2:]]})
+    return [{"base": args.base, "tables": tables, "output": args.output, "format": args.format, "match_mode": args.mode,
+             "history": args.history}]
+
+
+def disable_parse_pool():
+    """任务已经按进程并行了，任务内部就不再开解析进程池，避免进程数成倍增加"""
+    wms_core.PARSE_WORKERS = 1
+
+
+def run_all(jobs, workers):
+    """逐个返回（任务, 结果或异常）；多个任务时用进程池并行"""
+    if len(jobs) == 1 or workers <= 1:
+        for job in jobs:
+            try:
+                yield job, run_job(job)
+            except Exception as e:
+                yield job, e
+        return
+    with ProcessPoolExecutor(max_workers=min(workers, len(jobs)), initializer=disable_parse_pool) as pool:
+        futures = {pool.submit(run_job, job): job for job in jobs}
+        for future in as_completed(futures):
+            try:
+                yield futures[future], future.result()
+            except Exception as e:
+                yield futures[future], e
+
+
+def main(argv=None):
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    if (args.ingest or args.history) and not wms_core.HISTORY_ENABLED:
+        parser.error("历史订单库已关闭（WMS_HISTORY_DB=0），不能使用 --ingest / --history")
+    ingest_failed = 0
+    for token, key in args.ingest:
+        path, sheets = parse_table_path(token)
+        try:
+            count = wms_core.history_ingest_file(path, key, sheets)
+        except Exception as e:
+            ingest_failed += 1
+            print(f"❌ 存入历史库失败 {path}：{e}", file=sys.stderr)
+            continue
+        print(f"📚 {path}：" + ("已经存过了" if count is None else f"存入 {count} 个订单"))
+    if args.ingest and not (args.jobs or args.base):
+        return 1 if ingest_failed else 0
+    jobs = load_jobs(args, parser)
+    failed = 0
+    for job, result in run_all(jobs, args.workers):
+        if isinstance(result, Exception):
+            failed += 1
+            print(f"❌ {job['output']}：{result}", file=sys.stderr)
+        else:
+            matched = "，".join(f"{name}匹配 {count} 条" for name, count in result["matched"].items())
+            sheets = f"（拆成 {result['sheets']} 个工作表）" if result["sheets"] > 1 else ""
+            print(f"✅ {result['output']}：{result['rows']} 行{sheets}，{matched}，"
+                  f"一张表都没匹配到 {result['unmatched']} 条，耗时 {result['seconds']} 秒")
+    print(f"共 {len(jobs)} 个任务，成功 {len(jobs) - failed} 个，失败 {failed} 个")
+    return 1 if failed or ingest_failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
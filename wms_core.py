@@ -0,0 +1,1769 @@
+"""
+订单整合核心逻辑：清洗、读取、缓存、匹配索引、整合、导出
+不依赖 Streamlit，页面（wms.py）和命令行（wms_cli.py）共用同一套代码
+"""
+import pandas as pd
+import numpy as np
+from io import BytesIO, StringIO
+import re
+import os
+import csv
+import json
+import codecs
+import time
+import hashlib
+import sqlite3
+import zipfile
+from xml.etree import ElementTree
+import multiprocessing
+import threading
+import uuid
+import warnings
+import weakref
+from collections import OrderedDict
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
+from openpyxl.reader.excel import ExcelReader
+from openpyxl.xml.constants import SHARED_STRINGS, SHEET_MAIN_NS
+import xlsxwriter
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pa_csv
+import pyarrow.parquet as pq
+
+# 可选：Rust 原生 xlsx 解析器，装了就自动启用（pip install python-calamine）
+try:
+    import python_calamine  # noqa: F401
+    HAS_CALAMINE = True
+except ImportError:
+    HAS_CALAMINE = False
+# 可选：xxhash 计算文件指纹，比内置hash快一个数量级（pip install xxhash）
+try:
+    import xxhash
+    HAS_XXHASH = True
+except ImportError:
+    HAS_XXHASH = False
+# 可选：psutil 读进程内存，Windows / macOS 上性能诊断也能记录内存变化（pip install psutil）
+try:
+    import psutil
+    HAS_PSUTIL = True
+except ImportError:
+    HAS_PSUTIL = False
+
+# ===================== 核心函数（彻底修复0匹配+完美保留+号）=====================
+# 预编译正则，提升性能
+# 1. 只去除不可见字符、零宽空格、多余空格，不碰正常字符
+CLEAN_PATTERN = re.compile(r'[\u200b\u200c\u200d\uFEFF\u00A0\x00-\x1F\x7F\s]+')
+# 2. 专门处理Excel的_x00XX_转义，只还原+号，不碰其他内容
+EXCEL_PLUS_PATTERN = re.compile(r'_x002B_', re.IGNORECASE)
+# 3. 宽松匹配模式：只保留数字，解决格式差异问题
+ONLY_NUMBER_PATTERN = re.compile(r'[^0-9]')
+# 整列清洗专用：与上面三个正则匹配范围完全一致，但写成 Python re 和 Arrow(RE2) 都能识别的形式
+# （RE2 的 \s 只认 ASCII 空白，所以把 Python \s 覆盖的 Unicode 空白逐个列出），整列处理时走 C++ 正则内核
+VEC_CLEAN_REGEX = r'[\x00-\x20\x7F' + '\x85\xa0\u1680\u2000-\u200d\u2028\u2029\u202f\u205f\u3000\ufeff' + ']+'
+VEC_EXCEL_PLUS_REGEX = r'(?i)_x002B_'
+VEC_ONLY_NUMBER_REGEX = r'[^0-9]'
+
+# --------------------------
+# 1. 完美修复+号，不修改正常订单号
+# --------------------------
+def restore_plus_sign(s):
+    """
+    只还原Excel里的_x002B_为+号，不修改其他任何正常字符
+    彻底解决之前解码改坏订单号的问题
+    """
+    if not isinstance(s, str):
+        return s
+    # 只替换_x002B_为+号，大小写都兼容
+    return EXCEL_PLUS_PATTERN.sub('+', s)
+
+def clean_order_id(x, match_mode="strict"):
+    """
+    订单号清洗，分两种匹配模式：
+    - strict严格模式：只去空格和不可见字符，完整保留订单号所有内容（字母、数字、+、横杠、下划线）
+    - loose宽松模式：只保留数字，彻底解决格式差异导致的0匹配问题
+    """
+    if pd.isna(x) or x == "" or x is None:
+        return ""
+    # 第一步：先还原+号
+    s = restore_plus_sign(x)
+    s = str(s).strip()
+    # 第二步：去除不可见字符和多余空格
+    s = CLEAN_PATTERN.sub('', s)
+    # 第三步：根据匹配模式处理
+    if match_mode == "loose":
+        s = ONLY_NUMBER_PATTERN.sub('', s)
+    return s
+
+# --------------------------
+# 2. 向量化批量清洗（整列处理，结果与上面的逐个函数完全一致）
+# --------------------------
+def restore_plus_sign_series(s):
+    """
+    restore_plus_sign 的整列版本：
+    - 全是字符串的列直接走 pandas 向量化 str.replace，不再逐个单元格调用 Python 函数
+    - 混有数字/日期等非字符串的列，退回逐个处理，保证非字符串单元格原样保留
+    """
+    if pd.api.types.infer_dtype(s, skipna=True) in ("string", "empty"):
+        return s.astype("string[pyarrow]").str.replace(VEC_EXCEL_PLUS_REGEX, '+', regex=True)
+    return s.map(restore_plus_sign)
+
+def clean_order_ids(s, match_mode="strict"):
+    """
+    clean_order_id 的整列版本，strict/loose 两种模式输出与逐个调用完全一致：
+    空值/空串 → ""，其余按 还原+号 → 去不可见字符和空格 →（宽松模式）只留数字 的顺序处理
+    """
+    s = pd.Series(s, dtype=object) if not isinstance(s, pd.Series) else s
+    missing = s.isna() | (s == "")
+    if pd.api.types.infer_dtype(s, skipna=True) not in ("string", "empty"):
+        # 数字、日期等非字符串单元格按 str() 转成文本，与 clean_order_id 一致
+        s = s.map(lambda v: v if isinstance(v, str) else str(v))
+    s = s.where(~missing, "").astype("string[pyarrow]")
+    s = s.str.replace(VEC_EXCEL_PLUS_REGEX, '+', regex=True)
+    # 清洗正则已包含全部空白字符，等价于先 strip 再去除所有空白
+    s = s.str.replace(VEC_CLEAN_REGEX, '', regex=True)
+    if match_mode == "loose":
+        s = s.str.replace(VEC_ONLY_NUMBER_REGEX, '', regex=True)
+    return s
+
+# --------------------------
+# 3. 按列读取表格（Excel / CSV / TSV / Parquet）：先只扫表头，再只读用到的列
+# --------------------------
+def is_xlsx_bytes(file_bytes):
+    """xlsx 本质是 zip 包，以 PK 开头；老的 xls 是 OLE 格式，只能交给 pandas 读"""
+    return file_bytes[:4] == b"PK\x03\x04"
+
+def normalize_header(raw_header):
+    """
+    表头规范化，和 pandas 读出来的列名保持一致：
+    空表头 → Unnamed: 序号，重复列名 → 列名.1、列名.2 ...
+    """
+    columns = []
+    seen = {}
+    for i, name in enumerate(raw_header):
+        name = f"Unnamed: {i}" if name is None or name == "" else str(name)
+        if name in seen:
+            seen[name] += 1
+            name = f"{name}.{seen[name]}"
+        else:
+            seen[name] = 0
+        columns.append(name)
+    return columns
+
+def excel_cell_to_str(v):
+    """单元格转文本，规则与 pd.read_excel(dtype=str, keep_default_na=False) 相同"""
+    if v is None:
+        return ""
+    if isinstance(v, str):
+        return v
+    # 整数值的小数（Excel 里所有数字都是浮点）按整数输出，避免订单号变成 123.0
+    if isinstance(v, float) and v.is_integer():
+        return str(int(v))
+    return str(v)
+
+def read_excel_sheet_names(file_bytes):
+    """
+    列出所有工作表名，不解析任何单元格：
+    xlsx 直接从 zip 包里读 workbook.xml（几 KB），不经过 openpyxl（它打开工作簿时会先把共享字符串表整个读进来）
+    """
+    if not is_xlsx_bytes(file_bytes):
+        return pd.ExcelFile(BytesIO(file_bytes)).sheet_names
+    with zipfile.ZipFile(BytesIO(file_bytes)) as zf:
+        # workbook.xml 的位置以包关系文件为准，一般是 xl/workbook.xml
+        workbook_path = "xl/workbook.xml"
+        for rel in ElementTree.fromstring(zf.read("_rels/.rels")):
+            if rel.get("Type", "").endswith("/officeDocument"):
+                workbook_path = rel.get("Target", workbook_path).lstrip("/")
+        root = ElementTree.fromstring(zf.read(workbook_path))
+    # 只按标签名结尾匹配，兼容 Transitional 和 Strict 两种命名空间
+    return [el.get("name") for el in root.iter() if el.tag.rsplit("}", 1)[-1] == "sheet"]
+
+def read_shared_strings(xml_source):
+    """
+    共享字符串表的快速读取，结果和 openpyxl 自带的 read_string_table 完全一致（纯文本 + 富文本各段，不含注音）
+    openpyxl 会给每个字符串建一个带校验的 Text 对象，几十万个不重复订单号的工作簿光这一步就要十几秒，
+    而共享字符串表是整个工作簿共用的，只读一个小工作表也得先读完它
+    """
+    si_tag = f"{{{SHEET_MAIN_NS}}}si"
+    t_tag = f"{{{SHEET_MAIN_NS}}}t"
+    run_t_path = f"{{{SHEET_MAIN_NS}}}r/{t_tag}"
+    strings = []
+    for _, node in ElementTree.iterparse(xml_source):
+        if node.tag == si_tag:
+            text = (node.findtext(t_tag) or "") + "".join(t.text or "" for t in node.iterfind(run_t_path))
+            strings.append(text.replace("x005F_", ""))
+            node.clear()
+    return strings
+
+class FastStringsExcelReader(ExcelReader):
+    """openpyxl 的工作簿读取器，只把共享字符串表换成上面的快速读取，其余（样式、日期格式等）不变"""
+    def read_strings(self):
+        ct = self.package.find(SHARED_STRINGS)
+        if ct is not None:
+            with self.archive.open(ct.PartName[1:]) as src:
+                self.shared_strings = read_shared_strings(src)
+
+def open_workbook(file_bytes):
+    """只读模式打开 xlsx，等价于 openpyxl.load_workbook(read_only=True, data_only=True)"""
+    reader = FastStringsExcelReader(BytesIO(file_bytes), read_only=True, data_only=True)
+    reader.read()
+    return reader.wb
+
+def get_worksheet(wb, sheet):
+    """sheet 为 None 时取第一个工作表"""
+    return wb.worksheets[0] if sheet is None else wb[sheet]
+
+def read_excel_header(file_bytes, sheet=None):
+    """只读指定工作表（默认第一个）的表头行，不解析任何数据行"""
+    return read_excel_headers(file_bytes, [sheet])[sheet]
+
+def read_excel_headers(file_bytes, sheets):
+    """一次读多个工作表的表头 {工作表: 表头}，工作簿只打开一次"""
+    if not is_xlsx_bytes(file_bytes):
+        frames = pd.read_excel(BytesIO(file_bytes), sheet_name=[sheet or 0 for sheet in sheets], nrows=0)
+        return {sheet: normalize_header(frames[sheet or 0].columns) for sheet in sheets}
+    wb = open_workbook(file_bytes)
+    try:
+        return {sheet: read_header_row(get_worksheet(wb, sheet)) for sheet in sheets}
+    finally:
+        wb.close()
+
+def read_header_row(ws):
+    return normalize_header(next(ws.iter_rows(max_row=1, values_only=True), ()))
+
+def read_excel_columns(file_bytes, columns, sheet=None):
+    """
+    只读取指定工作表（默认第一个）的指定列（主键列 + 映射列），其余几十列、其他工作表都不解析、不占内存：
+    - 装了 python-calamine 时用 Rust 原生解析器
+    - xlsx 默认用 openpyxl 只读模式逐行流式读取，只取需要的列
+    - 老 xls 格式退回 pandas（usecols 只保留需要的列）
+    """
+    if HAS_CALAMINE or not is_xlsx_bytes(file_bytes):
+        header = read_excel_header(file_bytes, sheet)
+        col_idx = [header.index(c) for c in columns]
+        engine = "calamine" if HAS_CALAMINE else None
+        df = pd.read_excel(BytesIO(file_bytes), sheet_name=sheet or 0, engine=engine, usecols=sorted(set(col_idx)),
+                           dtype=str, keep_default_na=False)
+        df.columns = [header[i] for i in sorted(set(col_idx))]
+        return df[list(columns)].fillna("")
+
+    data = {c: [] for c in columns}
+    # 表头和数据在同一次打开里读，共享字符串表只读一遍
+    wb = open_workbook(file_bytes)
+    try:
+        ws = get_worksheet(wb, sheet)
+        header = read_header_row(ws)
+        col_idx = [header.index(c) for c in columns]
+        # 只解析需要的列区间，减少单元格对象的创建
+        min_col = min(col_idx)
+        rel_idx = [i - min_col for i in col_idx]
+        for row in ws.iter_rows(min_row=2, min_col=min_col + 1, max_col=max(col_idx) + 1, values_only=True):
+            # 空行也保留（和 pandas 一致）：每列单独解析、单独缓存，行数必须和读了哪些列无关，否则各列会错位
+            for c, i in zip(columns, rel_idx):
+                data[c].append(excel_cell_to_str(row[i]) if i < len(row) else "")
+    finally:
+        wb.close()
+    return pd.DataFrame(data, dtype=str)
+
+# 表格文件格式按文件内容判断（不看扩展名：磁盘缓存、共享存储只按内容hash区分文件）
+TABLE_FORMAT_LABELS = {"xlsx": "Excel", "xls": "Excel 97-2003", "csv": "CSV", "tsv": "TSV", "parquet": "Parquet"}
+# 上传控件接受的扩展名
+TABLE_UPLOAD_TYPES = ["xlsx", "xls", "csv", "tsv", "txt", "parquet"]
+TEXT_DELIMITERS = {"csv": ",", "tsv": "\t"}
+# 判断文本编码、分隔符、读表头时只看文件开头这么多字节
+TEXT_SNIFF_BYTES = 1024 * 1024
+
+def detect_table_format(file_bytes):
+    """xlsx 是 zip 包（PK 开头），xls 是 OLE 复合文档，Parquet 以 PAR1 开头；其余按文本表格，第一行里 Tab 比逗号多就是 TSV"""
+    if is_xlsx_bytes(file_bytes):
+        return "xlsx"
+    if file_bytes[:8] == b"\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1":
+        return "xls"
+    if file_bytes[:4] == b"PAR1":
+        return "parquet"
+    first_line = file_bytes[:TEXT_SNIFF_BYTES].split(b"\n", 1)[0]
+    return "tsv" if first_line.count(b"\t") > first_line.count(b",") else "csv"
+
+def detect_text_encoding(file_bytes):
+    """
+    文本表格的编码：开头一段能按 UTF-8 解码就是 UTF-8（带不带 BOM 都算），否则按 GBK 处理
+    （gb18030 是 GBK 的超集，WMS、Excel 另存为的「CSV（逗号分隔）」在中文 Windows 上都是这个编码）
+    """
+    try:
+        # 增量解码，开头一段截断在多字节字符中间也不算错
+        codecs.getincrementaldecoder("utf-8")().decode(file_bytes[:TEXT_SNIFF_BYTES], final=False)
+        return "utf-8"
+    except UnicodeDecodeError:
+        return "gb18030"
+
+def read_text_header(file_bytes, fmt):
+    """CSV / TSV 的表头（第一行），规范化规则和 Excel 相同"""
+    encoding = detect_text_encoding(file_bytes)
+    sample = file_bytes[:TEXT_SNIFF_BYTES].decode("utf-8-sig" if encoding == "utf-8" else encoding, errors="ignore")
+    return normalize_header(next(csv.reader(StringIO(sample), delimiter=TEXT_DELIMITERS[fmt]), []))
+
+def read_text_columns(file_bytes, fmt, columns):
+    """
+    CSV / TSV 只读指定列：Arrow 的多线程 CSV 解析器，所有列都按文本读（前导 0、+号、长数字订单号原样保留），
+    空单元格是空字符串不是空值；个别行列数不齐时 Arrow 会报错，退回 pandas 逐行容错解析
+    编码只看开头一段判断：开头全是英文数字、后面才出现中文的 GBK 文件会先被当成 UTF-8，解码失败时按 GBK 重读
+    """
+    header = read_text_header(file_bytes, fmt)
+    encoding = detect_text_encoding(file_bytes)
+    columns = list(dict.fromkeys(columns))
+    try:
+        return read_text_columns_encoded(file_bytes, fmt, header, columns, encoding)
+    except (UnicodeDecodeError, pa.ArrowInvalid):
+        if encoding != "utf-8":
+            raise
+        return read_text_columns_encoded(file_bytes, fmt, header, columns, "gb18030")
+
+def read_text_columns_encoded(file_bytes, fmt, header, columns, encoding):
+    """按指定编码读 CSV / TSV 的指定列；按 UTF-8 读到非 UTF-8 内容时直接抛出（由 read_text_columns 换编码重读）"""
+    try:
+        table = pa_csv.read_csv(
+            BytesIO(file_bytes),
+            read_options=pa_csv.ReadOptions(column_names=header, skip_rows=1, use_threads=True,
+                                            encoding="utf8" if encoding == "utf-8" else encoding),
+            # 单元格里可能有换行（备注、地址），必须按引号判断行尾
+            parse_options=pa_csv.ParseOptions(delimiter=TEXT_DELIMITERS[fmt], newlines_in_values=True),
+            convert_options=pa_csv.ConvertOptions(
+                include_columns=columns, column_types={c: pa.string() for c in columns},
+                strings_can_be_null=False, quoted_strings_can_be_null=False, null_values=[],
+            ),
+        )
+    except pa.ArrowInvalid as e:
+        if encoding == "utf-8" and "invalid UTF8" in str(e):
+            raise
+        df = pd.read_csv(BytesIO(file_bytes), sep=TEXT_DELIMITERS[fmt], header=None, skiprows=1, names=header,
+                         usecols=columns, dtype=str, keep_default_na=False,
+                         encoding="utf-8-sig" if encoding == "utf-8" else encoding)
+        return df[columns].fillna("")
+    return table.to_pandas(types_mapper=lambda t: pd.StringDtype("pyarrow") if pa.types.is_string(t) else None)
+
+def parquet_header(file_bytes):
+    """Parquet 的列名，不读数据；pandas 写入时带的索引列不算"""
+    schema = pq.read_schema(BytesIO(file_bytes))
+    index_columns = set(c for c in (schema.pandas_metadata or {}).get("index_columns", []) if isinstance(c, str))
+    return [name for name in schema.names if name not in index_columns]
+
+def arrow_column_to_text(column):
+    """Parquet 里带类型的列转成文本，规则同 excel_cell_to_str：空值（含 NaN）→ 空字符串，整数值的小数按整数输出"""
+    if pa.types.is_dictionary(column.type):
+        column = column.cast(column.type.value_type)
+    if pa.types.is_floating(column.type):
+        column = pc.if_else(pc.is_nan(column), pa.scalar(None, column.type), column)
+    if pa.types.is_timestamp(column.type):
+        # 和 Excel 里的日期单元格读出来一样，不带微秒
+        column = pc.strftime(column.cast(pa.timestamp("s", column.type.tz), safe=False), format="%Y-%m-%d %H:%M:%S")
+    if pa.types.is_boolean(column.type):
+        column = pc.if_else(column, "True", "False")
+    if not pa.types.is_string(column.type):
+        column = pc.cast(column, pa.string())
+    return pc.fill_null(column, "").to_pandas(types_mapper=lambda t: pd.StringDtype("pyarrow"))
+
+def read_parquet_columns(file_bytes, columns):
+    """Parquet 只读指定列（列式存储，其他列完全不解压），多线程解码"""
+    columns = list(dict.fromkeys(columns))
+    table = pq.read_table(BytesIO(file_bytes), columns=columns, use_threads=True)
+    return pd.DataFrame({c: arrow_column_to_text(table.column(c)) for c in columns})
+
+def read_table_sheet_names(file_bytes):
+    """工作表名；CSV / TSV / Parquet 没有工作表，当成只有一个以格式命名的工作表"""
+    fmt = detect_table_format(file_bytes)
+    if fmt in ("xlsx", "xls"):
+        return read_excel_sheet_names(file_bytes)
+    return [TABLE_FORMAT_LABELS[fmt]]
+
+def read_table_headers(file_bytes, sheets):
+    """按格式读多个工作表的表头 {工作表: 表头}"""
+    fmt = detect_table_format(file_bytes)
+    if fmt in ("xlsx", "xls"):
+        return read_excel_headers(file_bytes, sheets)
+    header = parquet_header(file_bytes) if fmt == "parquet" else read_text_header(file_bytes, fmt)
+    return {sheet: header for sheet in sheets}
+
+def read_table_columns(file_bytes, columns, sheet=None):
+    """按格式只读指定列，返回的都是文本列（和 read_excel_columns 相同）；CSV / TSV / Parquet 忽略 sheet"""
+    fmt = detect_table_format(file_bytes)
+    if fmt in ("xlsx", "xls"):
+        return read_excel_columns(file_bytes, columns, sheet)
+    if fmt == "parquet":
+        return read_parquet_columns(file_bytes, columns)
+    return read_text_columns(file_bytes, fmt, columns)
+
+# 选了多个工作表合并时，记录每行来自哪个工作表的虚拟列（可以像普通列一样映射导出）
+SHEET_COLUMN = "来源工作表"
+
+def load_sheet_names(file_hash, get_bytes):
+    """列出工作表名，磁盘缓存里有就不碰文件"""
+    names = disk_cache_load_json(file_hash, "__sheets__")
+    if names is None:
+        names = read_table_sheet_names(get_bytes())
+        disk_cache_save_json(file_hash, "__sheets__", names)
+    return names
+
+def load_headers(file_hash, get_bytes, sheets):
+    """
+    读多个工作表的表头 {工作表: 表头}，磁盘缓存里有就不碰文件；每个工作表按（文件hash, 工作表）单独缓存，没命中的一次读完
+    get_bytes：取文件字节的函数，只有缓存没命中时才调用（上传文件不用每次都复制一份字节）
+    """
+    def cache_name(sheet):
+        return "__header__" if sheet is None else f"__header__\x00{sheet}"
+    headers = {sheet: disk_cache_load_json(file_hash, cache_name(sheet)) for sheet in sheets}
+    missing = [sheet for sheet in sheets if headers[sheet] is None]
+    if missing:
+        for sheet, header in read_table_headers(get_bytes(), missing).items():
+            headers[sheet] = header
+            disk_cache_save_json(file_hash, cache_name(sheet), header)
+    return headers
+
+def resolve_sheets(sheet_names, selected=None):
+    """要读取的工作表：None 取第一个，"all" 取全部，否则按给定的名字（不存在的报错）"""
+    if selected is None:
+        return sheet_names[:1]
+    if selected == "all":
+        return list(sheet_names)
+    selected = [selected] if isinstance(selected, str) else list(selected)
+    unknown = [name for name in selected if name not in sheet_names]
+    if unknown:
+        raise ValueError(f"未找到工作表：{unknown}，当前工作表：{sheet_names}")
+    return selected
+
+def merge_sheet_headers(sheet_headers):
+    """
+    多个工作表合并时的表头：按出现顺序取所有工作表列名的并集
+    选了两个及以上工作表时，额外提供一列「来源工作表」（某个工作表本来就有同名列时不加）
+    """
+    merged = list(dict.fromkeys(c for header in sheet_headers.values() for c in header))
+    if len(sheet_headers) > 1 and SHEET_COLUMN not in merged:
+        merged.append(SHEET_COLUMN)
+    return merged
+
+# 多个文件同时有列要解析时，放进进程池并行解析（Excel 解析是纯 Python 的 CPU 密集任务，线程并行不起来；
+# CSV / Parquet 本身就是 Arrow 多线程解析，放进进程池也不冲突）
+# WMS_PARSE_WORKERS=1 表示关闭，全部在当前进程里顺序解析
+PARSE_WORKERS = int(os.environ.get("WMS_PARSE_WORKERS", str(min(4, os.cpu_count() or 1))))
+PARSE_POOL = None
+
+def get_parse_pool():
+    """进程池常驻复用，只在第一次并行解析时启动（子进程导入 pandas/pyarrow 的开销只付一次）"""
+    global PARSE_POOL
+    if PARSE_POOL is None:
+        # Streamlit 服务进程里有很多线程，直接 fork 可能继承到被锁住的锁，Linux 下用 forkserver 更稳妥
+        methods = multiprocessing.get_all_start_methods()
+        ctx = multiprocessing.get_context("forkserver" if "forkserver" in methods else None)
+        PARSE_POOL = ProcessPoolExecutor(max_workers=PARSE_WORKERS, mp_context=ctx)
+    return PARSE_POOL
+
+def table_to_ipc(df):
+    """DataFrame → Arrow IPC 字节流：整列就是几块连续内存，跨进程传递不用逐个 pickle 字符串对象"""
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue().to_pybytes()
+
+def table_from_ipc(data):
+    """Arrow IPC 字节流 → DataFrame，列数据直接引用收到的缓冲区（零拷贝）"""
+    table = pa.ipc.open_stream(pa.py_buffer(data)).read_all()
+    return table.to_pandas(types_mapper=lambda t: pd.StringDtype("pyarrow") if pa.types.is_string(t) else None)
+
+def align_columns(series_by_column):
+    """
+    分别解析、分别缓存的列拼成一张表：工作表缺少尺寸信息时，各列末尾的空行数可能不同，短的列在末尾补空字符串
+    （中间的空行 openpyxl 会按行号补齐，不会错位）
+    """
+    rows = max((len(s) for s in series_by_column.values()), default=0)
+    return pd.DataFrame({
+        c: s if len(s) == rows else pd.concat([s, pd.Series([""] * (rows - len(s)), dtype=s.dtype)], ignore_index=True)
+        for c, s in series_by_column.items()
+    })
+
+# 各格式实际解析（磁盘缓存没命中）的累计次数、行数、耗时：格式 → {"files", "rows", "seconds"}，诊断面板按格式对比
+LOAD_STATS = {}
+LOAD_STATS_LOCK = threading.Lock()
+
+def record_load(fmt, rows, seconds):
+    with LOAD_STATS_LOCK:
+        stats = LOAD_STATS.setdefault(fmt, {"files": 0, "rows": 0, "seconds": 0.0})
+        stats["files"] += 1
+        stats["rows"] += rows
+        stats["seconds"] += seconds
+
+def get_load_stats():
+    """按格式汇总的解析耗时，每个格式一行（没解析过任何文件时为空列表）"""
+    with LOAD_STATS_LOCK:
+        return [
+            {"格式": TABLE_FORMAT_LABELS[fmt], "解析次数": stats["files"], "行数": stats["rows"],
+             "耗时(秒)": round(stats["seconds"], 3),
+             "每秒行数": int(stats["rows"] / stats["seconds"]) if stats["seconds"] > 0 else None}
+            for fmt, stats in LOAD_STATS.items()
+        ]
+
+def timed_read_table_columns(file_bytes, columns, sheet):
+    """解析指定列并计时，返回（DataFrame, 格式, 耗时秒）"""
+    started = time.perf_counter()
+    df = read_table_columns(file_bytes, columns, sheet)
+    return df, detect_table_format(file_bytes), time.perf_counter() - started
+
+def parse_columns_ipc(file_bytes, columns, sheet):
+    """进程池子进程里执行：解析指定列，结果以 Arrow IPC 字节流返回（连同格式和解析耗时）"""
+    df, fmt, seconds = timed_read_table_columns(file_bytes, columns, sheet)
+    return table_to_ipc(df), fmt, seconds
+
+def load_columns_many(requests):
+    """
+    一次加载多个文件（工作表）的列：requests = [(文件hash, 取文件字节的函数, 列名元组, 工作表名或None), ...]，返回对应的 DataFrame 列表
+    磁盘缓存没命中的列如果分布在两个及以上文件（工作表）里，就放进进程池同时解析，等待时间从「各自解析时间之和」变成「最慢的那个」
+    出错的那个返回异常对象，不影响其他文件
+    每一列按（文件hash, 工作表, 列名）单独落盘：只解析缓存里没有的列，全部命中时不读取文件字节
+    +号不在这里还原：主键列在生成匹配键时还原，映射列在整合时还原
+    """
+    pending = []
+    for file_hash, get_bytes, columns, sheet in requests:
+        cached = {c: disk_cache_load_column(file_hash, c, sheet) for c in columns}
+        pending.append((file_hash, get_bytes, columns, sheet, cached, tuple(c for c in columns if cached[c] is None)))
+
+    to_parse = [i for i, item in enumerate(pending) if item[5]]
+    parsed = {}
+    if len(to_parse) >= 2 and PARSE_WORKERS > 1:
+        pool = get_parse_pool()
+        futures = {}
+        for i in to_parse:
+            try:
+                futures[i] = pool.submit(parse_columns_ipc, pending[i][1](), pending[i][5], pending[i][3])
+            except Exception as e:
+                parsed[i] = e
+        for i, future in futures.items():
+            try:
+                data, fmt, seconds = future.result()
+                parsed[i] = table_from_ipc(data)
+                record_load(fmt, len(parsed[i]), seconds)
+            except Exception as e:
+                parsed[i] = e
+    else:
+        for i in to_parse:
+            try:
+                parsed[i], fmt, seconds = timed_read_table_columns(pending[i][1](), pending[i][5], pending[i][3])
+                record_load(fmt, len(parsed[i]), seconds)
+            except Exception as e:
+                parsed[i] = e
+
+    results = []
+    for i, (file_hash, _, columns, sheet, cached, missing) in enumerate(pending):
+        if isinstance(parsed.get(i), Exception):
+            results.append(parsed[i])
+            continue
+        for c in missing:
+            cached[c] = parsed[i][c]
+            disk_cache_save_column(file_hash, c, parsed[i][c], sheet)
+        results.append(align_columns({c: cached[c] for c in columns}))
+    return results
+
+def load_sheets_columns_many(requests):
+    """
+    一次加载多张表，每张表可以选多个工作表上下拼接：
+    requests = [(文件hash, 取文件字节的函数, {工作表名: 表头}, 列名元组[第一列是主键列]), ...]
+    每个工作表是一个独立的解析任务（一起交给 load_columns_many，没缓存的并行解析），只解析选中的工作表
+    某个工作表没有的映射列填空字符串；连主键列都没有的工作表整个跳过
+    返回每张表拼接好的 DataFrame，出错的返回异常对象
+    """
+    flat, owners = [], []
+    for i, (file_hash, get_bytes, sheet_headers, columns) in enumerate(requests):
+        for sheet, header in sheet_headers.items():
+            present = tuple(c for c in columns if c in header) if columns[0] in header else ()
+            flat.append((file_hash, get_bytes, present, sheet))
+            owners.append(i)
+    frames = [[] for _ in requests]
+    for i, (_, _, _, sheet), df in zip(owners, flat, load_columns_many(flat)):
+        frames[i].append((sheet, df))
+
+    results = []
+    for (_, _, sheet_headers, columns), parts in zip(requests, frames):
+        error = next((df for _, df in parts if isinstance(df, Exception)), None)
+        if error is not None:
+            results.append(error)
+            continue
+        if len(parts) == 1 and all(c in parts[0][1].columns for c in columns):
+            results.append(compact_table(parts[0][1], columns[0]))
+            continue
+        aligned = []
+        for sheet, df in parts:
+            df = df.reindex(columns=list(columns), fill_value="")
+            if SHEET_COLUMN in columns and SHEET_COLUMN not in sheet_headers[sheet]:
+                df[SHEET_COLUMN] = sheet
+            aligned.append(df.astype("string[pyarrow]"))
+        results.append(compact_table(pd.concat(aligned, ignore_index=True), columns[0]))
+    return results
+
+# 不同值的个数不超过行数的这个比例时，映射列存成分类列（状态、仓库、快递公司、来源工作表……）
+CATEGORY_MAX_RATIO = 0.5
+
+def compact_table(df, key):
+    """
+    读入的表转成紧凑的列式存储，会话里长期保存的就是这份：
+    - 所有列都是 Arrow 字符串列（几块连续内存，不是一个个 Python 字符串对象）
+    - 主键以外重复值多的列转成分类列：每行只存一个整数编码，不同的值只存一份
+    主键列保持字符串列，建匹配索引、相似查找都直接用
+    """
+    columns = {}
+    for c in df.columns:
+        s = df[c].astype("string[pyarrow]")
+        if c != key and len(s) > 0:
+            codes, uniques = pd.factorize(s)
+            if len(uniques) <= len(s) * CATEGORY_MAX_RATIO:
+                s = pd.Series(pd.Categorical.from_codes(codes, categories=uniques), name=c)
+        columns[c] = s
+    return pd.DataFrame(columns)
+
+def table_memory_bytes(df):
+    """表数据实际占用的内存（字节）：Arrow 列按缓冲区大小，分类列按编码 + 不同值，object 列按每个 Python 对象"""
+    return int(df.memory_usage(deep=True, index=False).sum())
+
+# --------------------------
+# 4. 磁盘缓存：解析结果按列存成 Parquet，按字节上限做 LRU 淘汰
+# --------------------------
+# 缓存目录和容量上限可以用环境变量调整，WMS_CACHE_MAX_MB=0 表示关闭磁盘缓存
+DISK_CACHE_DIR = os.environ.get("WMS_CACHE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), ".wms_cache"))
+DISK_CACHE_MAX_BYTES = int(float(os.environ.get("WMS_CACHE_MAX_MB", "2048")) * 1024 * 1024)
+
+# 缓存格式版本：解析规则变化时加一，旧版本的缓存文件不再命中，由 LRU 自然淘汰
+# 2：空行不再跳过，各列行数一致
+DISK_CACHE_VERSION = 2
+
+# 进程级的命中统计（所有会话共享，页面脚本重跑不会清零）
+DISK_CACHE_STATS = {"hits": 0, "misses": 0, "evictions": 0, "write_errors": 0}
+
+def get_disk_cache_stats():
+    return DISK_CACHE_STATS
+
+def disk_cache_path(file_hash, name, ext):
+    """缓存文件路径：列名做一次hash，避免特殊字符进文件名"""
+    name_hash = hashlib.md5(str(name).encode("utf-8")).hexdigest()[:16]
+    return os.path.join(DISK_CACHE_DIR, f"{file_hash}_v{DISK_CACHE_VERSION}_{name_hash}.{ext}")
+
+def disk_cache_touch(path):
+    """命中后刷新修改时间，LRU 淘汰按修改时间从旧到新删"""
+    try:
+        os.utime(path)
+    except OSError:
+        pass
+
+def disk_cache_write(path, write_fn):
+    """
+    先写临时文件再原子替换，多个会话同时写同一个文件也不会读到半截数据
+    会话是同一进程里的线程，临时文件名每次写都不一样，互相不会抢同一个临时文件
+    写缓存失败（磁盘满、没权限……）只记一次警告，不影响已经解析好的数据
+    """
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    try:
+        os.makedirs(DISK_CACHE_DIR, exist_ok=True)
+        write_fn(tmp_path)
+        os.replace(tmp_path, path)
+    except (OSError, pa.ArrowException) as e:
+        get_disk_cache_stats()["write_errors"] += 1
+        warnings.warn(f"磁盘缓存写入失败：{path}：{e}")
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        return
+    disk_cache_evict()
+
+def disk_cache_load_json(file_hash, name):
+    """读缓存的小型元数据（表头、工作表名）"""
+    if DISK_CACHE_MAX_BYTES <= 0:
+        return None
+    path = disk_cache_path(file_hash, name, "json")
+    try:
+        with open(path, encoding="utf-8") as f:
+            value = json.load(f)
+    except (OSError, ValueError):
+        return None
+    disk_cache_touch(path)
+    return value
+
+def disk_cache_save_json(file_hash, name, value):
+    if DISK_CACHE_MAX_BYTES <= 0:
+        return
+    def write(tmp_path):
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(value, f, ensure_ascii=False)
+    disk_cache_write(disk_cache_path(file_hash, name, "json"), write)
+
+def disk_cache_column_name(column, sheet):
+    """第一个工作表的旧缓存（sheet 为 None）沿用列名本身，其他工作表加上工作表名区分"""
+    return column if sheet is None else f"{sheet}\x00{column}"
+
+def disk_cache_load_column(file_hash, column, sheet=None):
+    """
+    读缓存列：Parquet 用内存映射打开，直接转成 Arrow 字符串列，不逐个创建 Python 字符串
+    没命中（或缓存关闭、文件损坏）返回 None
+    """
+    if DISK_CACHE_MAX_BYTES <= 0:
+        return None
+    stats = get_disk_cache_stats()
+    path = disk_cache_path(file_hash, disk_cache_column_name(column, sheet), "parquet")
+    try:
+        table = pq.read_table(path, memory_map=True)
+    except (OSError, pa.ArrowException):
+        stats["misses"] += 1
+        return None
+    stats["hits"] += 1
+    disk_cache_touch(path)
+    return table.column(0).to_pandas(types_mapper=lambda t: pd.StringDtype("pyarrow")).rename(column)
+
+def disk_cache_save_column(file_hash, column, series, sheet=None):
+    if DISK_CACHE_MAX_BYTES <= 0:
+        return
+    table = pa.table({"value": pa.array(series.astype(str), type=pa.string())})
+    disk_cache_write(disk_cache_path(file_hash, disk_cache_column_name(column, sheet), "parquet"), lambda p: pq.write_table(table, p))
+
+def disk_cache_usage():
+    """返回（缓存文件列表[(修改时间, 字节数, 路径)], 总字节数）"""
+    entries = []
+    try:
+        names = os.listdir(DISK_CACHE_DIR)
+    except OSError:
+        return entries, 0
+    for name in names:
+        if name.endswith(".tmp"):
+            continue
+        path = os.path.join(DISK_CACHE_DIR, name)
+        try:
+            info = os.stat(path)
+        except OSError:
+            continue
+        entries.append((info.st_mtime, info.st_size, path))
+    return entries, sum(e[1] for e in entries)
+
+def disk_cache_evict():
+    """超过字节上限时，按最近使用时间从旧到新删除，直到回到上限以内"""
+    entries, total = disk_cache_usage()
+    if total <= DISK_CACHE_MAX_BYTES:
+        return
+    stats = get_disk_cache_stats()
+    for _, size, path in sorted(entries):
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        stats["evictions"] += 1
+        total -= size
+        if total <= DISK_CACHE_MAX_BYTES:
+            break
+
+def disk_cache_clear():
+    entries, _ = disk_cache_usage()
+    for _, _, path in entries:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+# --------------------------
+# 5. 双模式匹配索引：每张表上传后只建一次，切换模式、统计、合并都只是查索引
+# --------------------------
+def build_match_index(key_series):
+    """
+    为一张表建匹配索引，strict / loose 两种模式各一份：
+    - keys：去重后的匹配键（按首次出现顺序）
+    - first_pos：每个匹配键第一次出现的行号（合并时取这一行，等价于原来的 drop_duplicates keep=first）
+    - dup_counts：每个匹配键在表里出现的次数
+    原始表格不做任何修改和去重
+    """
+    match_index = {}
+    for mode in ("strict", "loose"):
+        codes, uniques = pd.factorize(clean_order_ids(key_series, mode))
+        # factorize 的编码按首次出现顺序递增，return_index 正好是每个键的首行行号
+        _, first_pos = np.unique(codes, return_index=True)
+        match_index[mode] = {
+            "keys": pd.Index(uniques),
+            "first_pos": first_pos,
+            "dup_counts": np.bincount(codes, minlength=len(uniques)),
+        }
+    return match_index
+
+def match_index_bytes(match_index):
+    """匹配索引占用的内存（字节）：两种模式的去重匹配键 + 行号、次数数组"""
+    return int(sum(
+        entry["keys"].memory_usage(deep=True) + entry["first_pos"].nbytes + entry["dup_counts"].nbytes
+        for entry in match_index.values()
+    ))
+
+def as_key_index(keys):
+    """匹配键转成 Arrow 字符串索引；多张表共用同一份，避免每张表都把 Python 列表重新转换、哈希一遍"""
+    if isinstance(keys, pd.Index):
+        return keys
+    return pd.Index(pd.array(list(keys), dtype="string[pyarrow]"))
+
+def lookup_match_positions(match_index, match_mode, base_keys, aliases=None):
+    """
+    基准匹配键 → 表里对应的行号，没匹配到的为 -1（一次哈希查找，不再逐行比较）
+    aliases：人工确认的相似配对（基准匹配键 → 表内匹配键），查找前先替换
+    """
+    entry = match_index[match_mode]
+    if aliases:
+        base_keys = [aliases.get(k, k) for k in base_keys]
+    if not isinstance(base_keys, pd.Index):
+        base_keys = as_key_index(base_keys)
+    idx = entry["keys"].get_indexer(base_keys)
+    return np.where(idx >= 0, entry["first_pos"][np.maximum(idx, 0)], -1)
+
+def take_by_positions(series, positions):
+    """按行号从表里取值，行号为 -1（没匹配到）的填空字符串；分类列按编码取，结果是字符串列"""
+    if isinstance(series.dtype, pd.CategoricalDtype):
+        # 不同值后面补一个空字符串，没匹配到的行取它
+        categories = pd.array(list(series.cat.categories) + [""], dtype="string[pyarrow]")
+        codes = pd.api.extensions.take(series.cat.codes.to_numpy(), positions, allow_fill=True, fill_value=-1)
+        return categories.take(np.where(codes >= 0, codes, len(categories) - 1))
+    return pd.api.extensions.take(series.array, positions, allow_fill=True, fill_value="")
+
+# --------------------------
+# 6. 未匹配订单的相似候选：n-gram 倒排索引 + 编辑距离复核
+# --------------------------
+# n-gram 长度：订单号大多是数字，3-gram 只有1000种，区分度太低，用5位
+SUGGEST_NGRAM = 5
+# 出现在太多订单号里的片段（日期前缀、店铺前缀等）没有区分度，查候选时跳过
+SUGGEST_MAX_POSTING = 2000
+# 每个未匹配订单先按共同片段数取前几名，再算编辑距离
+SUGGEST_CANDIDATES = 5
+
+def build_ngram_index(keys, n=SUGGEST_NGRAM):
+    """
+    给表里去重后的匹配键建 n-gram 倒排索引（全部用 Arrow/numpy 向量化完成）：
+    - grams：所有出现过的片段
+    - starts/ends：每个片段在 key_ids 里的区间，区间内就是包含这个片段的匹配键编号
+    """
+    arr = pa.array(np.asarray(keys, dtype=object), type=pa.string())
+    lengths = pc.utf8_length(arr).to_numpy(zero_copy_only=False)
+    gram_chunks, id_chunks = [], []
+    for j in range(int(lengths.max(initial=0)) - n + 1):
+        ids = np.flatnonzero(lengths >= j + n)
+        gram_chunks.append(pc.utf8_slice_codeunits(arr.take(pa.array(ids)), j, j + n))
+        id_chunks.append(ids)
+    if not gram_chunks:
+        return {"n": n, "grams": pd.Index([], dtype=object), "starts": np.zeros(0, dtype=np.int64),
+                "ends": np.zeros(0, dtype=np.int64), "key_ids": np.zeros(0, dtype=np.int64)}
+    encoded = pc.dictionary_encode(pa.concat_arrays(gram_chunks))
+    codes = encoded.indices.to_numpy()
+    key_ids = np.concatenate(id_chunks)
+    order = np.argsort(codes, kind="stable")
+    counts = np.bincount(codes, minlength=len(encoded.dictionary))
+    ends = np.cumsum(counts)
+    return {
+        "n": n,
+        "grams": pd.Index(encoded.dictionary.to_pylist()),
+        "starts": ends - counts,
+        "ends": ends,
+        "key_ids": key_ids[order],
+    }
+
+def osa_distance(a, b, max_dist):
+    """
+    编辑距离（含相邻字符互换，如 12↔21 算一次）；超过 max_dist 直接返回 max_dist+1
+    先去掉共同前后缀（近似订单号通常只差中间一两位），剩下的部分只算对角线附近 max_dist 宽的区域
+    """
+    if abs(len(a) - len(b)) > max_dist:
+        return max_dist + 1
+    prefix = len(os.path.commonprefix([a, b]))
+    a, b = a[prefix:], b[prefix:]
+    suffix = len(os.path.commonprefix([a[::-1], b[::-1]]))
+    if suffix:
+        a, b = a[:-suffix], b[:-suffix]
+    if not a or not b:
+        return min(max(len(a), len(b)), max_dist + 1)
+    big = max_dist + 1
+    prev2 = None
+    prev = list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        ca = a[i - 1]
+        cur = [big] * (len(b) + 1)
+        cur[0] = i
+        lo, hi = max(1, i - max_dist), min(len(b), i + max_dist)
+        row_min = big if lo > 1 else i
+        for j in range(lo, hi + 1):
+            cb = b[j - 1]
+            d = prev[j - 1] if ca == cb else prev[j - 1] + 1
+            if prev[j] + 1 < d:
+                d = prev[j] + 1
+            if cur[j - 1] + 1 < d:
+                d = cur[j - 1] + 1
+            if prev2 is not None and j > 1 and ca == b[j - 2] and a[i - 2] == cb and prev2[j - 2] + 1 < d:
+                d = prev2[j - 2] + 1
+            cur[j] = d
+            if d < row_min:
+                row_min = d
+        if row_min > max_dist:
+            return big
+        prev2, prev = prev, cur
+    return min(prev[len(b)], big)
+
+def suggest_similar_keys(ngram_index, table_keys, query_keys, top_k=3, max_dist=3):
+    """
+    为每个未匹配的基准匹配键找表里最相近的匹配键：
+    1. 所有查询的 n-gram 一次性查倒排索引，按共同片段数批量计数（不做 N×M 两两比较）
+    2. 每个查询只对共同片段最多的前几名候选算编辑距离
+    返回 DataFrame：query_pos, key_pos, distance, shared_prefix, shared_suffix
+    """
+    n = ngram_index["n"]
+    q_ids, q_grams = [], []
+    for qi, k in enumerate(query_keys):
+        for g in {k[j:j + n] for j in range(len(k) - n + 1)}:
+            q_ids.append(qi)
+            q_grams.append(g)
+    empty = pd.DataFrame(columns=["query_pos", "key_pos", "distance", "shared_prefix", "shared_suffix"])
+    if not q_grams:
+        return empty
+    codes = ngram_index["grams"].get_indexer(q_grams)
+    q_ids = np.asarray(q_ids, dtype=np.int64)
+    starts = np.where(codes >= 0, ngram_index["starts"][codes], 0)
+    ends = np.where(codes >= 0, ngram_index["ends"][codes], 0)
+    lengths = ends - starts
+    lengths[(codes < 0) | (lengths > SUGGEST_MAX_POSTING)] = 0
+    total = int(lengths.sum())
+    if total == 0:
+        return empty
+    # 把每个查询片段命中的倒排区间展开成（查询编号, 匹配键编号）对
+    rep_q = np.repeat(q_ids, lengths)
+    offsets = np.repeat(starts - (np.cumsum(lengths) - lengths), lengths) + np.arange(total)
+    shift = max(len(table_keys), 1).bit_length()
+    pairs = (rep_q << shift) | ngram_index["key_ids"][offsets]
+    uniq, shared = np.unique(pairs, return_counts=True)
+    pq_, pk_ = uniq >> shift, uniq & ((1 << shift) - 1)
+    # unique 之后已按查询编号分好组：先去掉只有1个共同片段、或不到本组最佳一半的候选，剩下的很少，再排序取前几名
+    group_start = np.r_[0, np.flatnonzero(np.diff(pq_)) + 1]
+    group_size = np.diff(np.r_[group_start, len(pq_)])
+    strong = (shared >= 2) & (shared * 2 >= np.repeat(np.maximum.reduceat(shared, group_start), group_size))
+    pq_, pk_, shared = pq_[strong], pk_[strong], shared[strong]
+    if len(pq_) == 0:
+        return empty
+    order = np.lexsort((-shared, pq_))
+    pq_, pk_ = pq_[order], pk_[order]
+    group_start = np.r_[0, np.flatnonzero(np.diff(pq_)) + 1]
+    rank = np.arange(len(pq_)) - np.repeat(group_start, np.diff(np.r_[group_start, len(pq_)]))
+    keep = rank < SUGGEST_CANDIDATES
+    rows = []
+    for qi, ki in zip(pq_[keep].tolist(), pk_[keep].tolist()):
+        q, k = query_keys[qi], table_keys[ki]
+        dist = osa_distance(q, k, max_dist)
+        if dist > max_dist:
+            continue
+        prefix = len(os.path.commonprefix([q, k]))
+        suffix = len(os.path.commonprefix([q[::-1], k[::-1]]))
+        rows.append((qi, ki, dist, prefix, suffix))
+    if not rows:
+        return empty
+    result = pd.DataFrame(rows, columns=empty.columns)
+    result = result.sort_values(["query_pos", "distance", "shared_suffix", "shared_prefix"],
+                                ascending=[True, True, False, False])
+    return result.groupby("query_pos", sort=False).head(top_k).reset_index(drop=True)
+
+# --------------------------
+# 7. 文件指纹
+# --------------------------
+HASH_CHUNK_SIZE = 8 * 1024 * 1024
+
+def hash_file_content(file):
+    """
+    流式计算文件内容指纹：直接在上传缓冲区上分块计算，不复制文件字节
+    有 xxhash 用 xxh3_128，否则用带硬件加速的 sha256（比 md5 快一倍）
+    """
+    h = xxhash.xxh3_128() if HAS_XXHASH else hashlib.sha256()
+    with file.getbuffer() as buf:
+        for i in range(0, len(buf), HASH_CHUNK_SIZE):
+            h.update(buf[i:i + HASH_CHUNK_SIZE])
+    return h.hexdigest()[:32]
+
+def memo_file_hash(file, memo, hasher=hash_file_content):
+    """
+    同一次上传（上传组件的 file_id 不变）只计算一次指纹，之后每次重跑直接查表，几乎零开销
+    memo 是 file_id → 指纹 的字典，由调用方保存（页面上放在 session_state 里）
+    """
+    file_id = getattr(file, "file_id", None)
+    if file_id is not None and file_id in memo:
+        return memo[file_id]
+    file_hash = hasher(file)
+    if file_id is not None:
+        memo[file_id] = file_hash
+    return file_hash
+
+# --------------------------
+# 8. 整合流程：基准订单 → 按映射从各表取列 → 导出
+# --------------------------
+# 导出结果里基准订单号那一列的列名
+BASE_ORDER_COLUMN = "订单编号"
+
+def base_order_lines(lines):
+    """基准订单号的原始行（列表或整列）：去掉首尾空白，空行不算，返回 Arrow 字符串列"""
+    s = lines if isinstance(lines, pd.Series) else pd.Series(lines, dtype=object)
+    s = s.astype("string[pyarrow]").str.strip()
+    return s[s != ""].reset_index(drop=True)
+
+def parse_base_orders(lines, match_mode="strict"):
+    """
+    解析基准订单号：按当前模式的匹配键去重、保留首次出现的顺序（整列向量化处理，20 万行也在 1 秒内）
+    返回（订单号列表[严格模式清洗，保留完整内容], 匹配键列表）
+    """
+    # 原始订单号用严格模式保留完整内容，匹配键在它的基础上再按模式清洗（严格模式清洗重复做结果不变）
+    orders = clean_order_ids(base_order_lines(lines), "strict")
+    keys = orders if match_mode == "strict" else clean_order_ids(orders, match_mode)
+    keep = (keys != "") & ~keys.duplicated()
+    return orders[keep].tolist(), keys[keep].tolist()
+
+def integrate_tables(base_orders, base_keys, match_mode, tables, progress=None):
+    """
+    按匹配索引把各表的映射列对齐到基准订单顺序（不逐表 merge、不复制整表）
+    base_keys：匹配键列表，或者已经转好的 as_key_index(匹配键)
+    tables：[{"name": 表名, "df": 表数据, "index": 匹配索引, "mappings": [(原列, 新列)], "aliases": 人工配对或None}]
+    progress：可选，每取完一列调用 progress("merge", 已取列数, 总列数)
+    返回（结果表, {表名: 每个基准订单是否匹配到的布尔数组}）
+    """
+    result_cols = {BASE_ORDER_COLUMN: base_orders}
+    matched = {}
+    base_index = as_key_index(base_keys)
+    tables = [t for t in tables if t["df"] is not None and t["index"] is not None and len(t["mappings"]) > 0]
+    total = sum(len(t["mappings"]) for t in tables)
+    done = 0
+    for table in tables:
+        aliases = table.get("aliases")
+        positions = lookup_match_positions(table["index"], match_mode, base_keys if aliases else base_index, aliases)
+        matched[table["name"]] = positions >= 0
+        for o, n in table["mappings"]:
+            # 只对取出来的基准行还原+号
+            values = restore_plus_sign_series(pd.Series(take_by_positions(table["df"][o], positions)))
+            # 列名重复时加上表名，避免覆盖
+            name = n if n not in result_cols else f"{n}_{table['name']}"
+            result_cols[name] = values.array
+            done += 1
+            if progress is not None:
+                progress("merge", done, total)
+    return pd.DataFrame(result_cols).fillna(""), matched
+
+# Excel 单个工作表最多 1,048,576 行（含表头），超出就自动拆到下一个工作表
+EXCEL_MAX_ROWS = 1048576
+# 流式导出时每次从 DataFrame 取出转成 Python 对象的行数，决定导出时额外占用的内存
+EXPORT_CHUNK_ROWS = 50000
+
+def iter_row_chunks(final_df, start, stop):
+    """按块把 [start, stop) 行转成 Python 行元组，避免一次性把整张表转成对象"""
+    for chunk_start in range(start, stop, EXPORT_CHUNK_ROWS):
+        chunk_stop = min(chunk_start + EXPORT_CHUNK_ROWS, stop)
+        columns = [final_df[c].iloc[chunk_start:chunk_stop].tolist() for c in final_df.columns]
+        yield from zip(*columns)
+
+def find_unmatched(matched, rows):
+    """
+    一张表都没匹配到的基准订单行号：直接由各表的匹配标记求，O(行数)，不读结果表的内容
+    （映射列的值本来就是空的订单也算匹配到了，不会被误判成未匹配）
+    """
+    any_matched = np.zeros(rows, dtype=bool)
+    for flags in matched.values():
+        any_matched |= flags
+    return np.flatnonzero(~any_matched)
+
+# 导出时每写这么多行汇报一次进度（progress("export", 已写行数, 总行数)）
+EXPORT_PROGRESS_ROWS = 10000
+
+def excel_sheet_count(total, rows_per_sheet=EXCEL_MAX_ROWS - 1):
+    """导出 xlsx 时要拆成几个工作表（不导出也能先告诉用户）"""
+    return max(1, -(-total // rows_per_sheet))
+
+def export_excel(final_df, output, rows_per_sheet=EXCEL_MAX_ROWS - 1, progress=None):
+    """
+    导出 xlsx，output 可以是文件路径或 BytesIO
+    用 xlsxwriter 的 constant_memory 模式逐行写出（写完一行就落到临时文件，不在内存里攒整个工作簿），
+    超过 Excel 行数上限时自动拆成「整合结果」「整合结果2」……多个工作表
+    返回工作表数量
+    """
+    workbook = xlsxwriter.Workbook(output, {"constant_memory": True})
+    # 表头样式和 pandas.to_excel 的默认样式一致
+    header_format = workbook.add_format({"bold": True, "border": 1, "align": "center", "valign": "top"})
+    headers = [str(c) for c in final_df.columns]
+    total = len(final_df)
+    sheet_count = excel_sheet_count(total, rows_per_sheet)
+    for sheet_no in range(sheet_count):
+        ws = workbook.add_worksheet("整合结果" if sheet_no == 0 else f"整合结果{sheet_no + 1}")
+        # 自动调整列宽
+        ws.set_column(0, 0, 28)
+        if len(headers) > 1:
+            ws.set_column(1, len(headers) - 1, 22)
+        ws.write_row(0, 0, headers, header_format)
+        start = sheet_no * rows_per_sheet
+        for r, row in enumerate(iter_row_chunks(final_df, start, min(start + rows_per_sheet, total)), 1):
+            ws.write_row(r, 0, row)
+            if progress is not None and r % EXPORT_PROGRESS_ROWS == 0:
+                progress("export", start + r, total)
+    workbook.close()
+    return sheet_count
+
+def export_csv(final_df, output, progress=None):
+    """导出 CSV：UTF-8 带 BOM，Excel 双击打开不乱码；没有行数上限，按块写出"""
+    handle = open(output, "wb") if isinstance(output, str) else output
+    try:
+        handle.write("\ufeff".encode("utf-8"))
+        total = len(final_df)
+        # 空表也要写表头，至少写一块
+        for start in range(0, max(total, 1), EXPORT_CHUNK_ROWS):
+            final_df.iloc[start:start + EXPORT_CHUNK_ROWS].to_csv(handle, index=False, header=start == 0, encoding="utf-8")
+            if progress is not None:
+                progress("export", min(start + EXPORT_CHUNK_ROWS, total), total)
+    finally:
+        if isinstance(output, str):
+            handle.close()
+    return 1
+
+def export_parquet(final_df, output, progress=None):
+    """
+    导出 Parquet：列式压缩存储，适合交给下游程序继续处理；按块写成多个行组
+    结果表全是文本列，schema 直接定成字符串：从空表推断的话，pandas 2 的 object 列会推成 null 类型，写第一块就报错
+    """
+    total = len(final_df)
+    schema = pa.schema([(str(c), pa.string()) for c in final_df.columns])
+    with pq.ParquetWriter(output, schema, compression="zstd") as writer:
+        for start in range(0, total, EXPORT_CHUNK_ROWS):
+            chunk = final_df.iloc[start:start + EXPORT_CHUNK_ROWS]
+            writer.write_table(pa.Table.from_pandas(chunk, schema=schema, preserve_index=False))
+            if progress is not None:
+                progress("export", min(start + EXPORT_CHUNK_ROWS, total), total)
+    return 1
+
+# 导出格式：扩展名 → (说明, MIME 类型, 导出函数)
+EXPORT_FORMATS = {
+    "xlsx": ("Excel", "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet", export_excel),
+    "csv": ("CSV（UTF-8 BOM）", "text/csv", export_csv),
+    "parquet": ("Parquet", "application/vnd.apache.parquet", export_parquet),
+}
+
+def export_format_from_path(path):
+    """按文件扩展名判断导出格式，不认识的扩展名按 xlsx 处理"""
+    ext = os.path.splitext(path)[1].lower().lstrip(".")
+    return ext if ext in EXPORT_FORMATS else "xlsx"
+
+def export_result(final_df, output, fmt="xlsx", progress=None):
+    """按格式导出整合结果，返回写出的工作表数量（CSV / Parquet 固定为 1）"""
+    return EXPORT_FORMATS[fmt][2](final_df, output, progress=progress)
+
+def decode_text(raw):
+    """文本文件字节转字符串，兼容 UTF-8（含BOM）和 Windows 记事本常见的 GBK 编码"""
+    try:
+        return raw.decode("utf-8-sig")
+    except UnicodeDecodeError:
+        return raw.decode("gb18030")
+
+def read_text_lines(path):
+    """读文本文件的所有行"""
+    with open(path, "rb") as f:
+        return decode_text(f.read()).splitlines()
+
+# csv / xlsx / parquet 格式的基准订单号文件里认作订单号的列名，都没有时取第一列
+BASE_ORDER_COLUMNS = ("订单编号", "线上订单号")
+
+def pick_base_order_column(header):
+    """基准订单号文件里订单号所在的列"""
+    if not header:
+        raise ValueError("文件里没有任何列")
+    return next((c for c in BASE_ORDER_COLUMNS if c in header), header[0])
+
+def read_base_order_lines(file_bytes, name):
+    """
+    读基准订单号文件，返回原始订单号（Arrow 字符串列，还没清洗、去重）：
+    - txt（及其他扩展名）：每行一个
+    - csv / tsv / xlsx / xls / parquet：第一行是表头（Excel 取第一个工作表），只读订单号那一列
+    """
+    ext = os.path.splitext(name)[1].lower()
+    if ext in (".xlsx", ".xls", ".csv", ".tsv", ".parquet"):
+        column = pick_base_order_column(read_table_headers(file_bytes, [None])[None])
+        return read_table_columns(file_bytes, [column])[column].astype("string[pyarrow]")
+    return pd.Series(decode_text(file_bytes).splitlines(), dtype="string[pyarrow]")
+
+def run_job(job):
+    """
+    无界面跑一个完整整合任务（命令行、定时任务、进程池都用这个）：
+    job = {
+        "base": 基准订单号文件（txt 每行一个，或 csv / xlsx 的订单编号列）,
+        "tables": [{"path": 表格文件, "key": 主键列, "mappings": [[原列, 新列], ...], "name": 可选表名,
+                    "sheets": 可选，工作表名列表或 "all"（默认第一个工作表）}],
+        "output": 导出文件路径（.xlsx / .csv / .parquet）,
+        "format": "xlsx" / "csv" / "parquet"（可选，默认按 output 的扩展名判断）,
+        "match_mode": "strict" / "loose"（可选，默认 strict）,
+        "history": 可选，从历史订单库取的列名列表（历史库当成一张名为「历史库」的表参与整合）
+    }
+    返回任务汇总 dict
+    """
+    started = time.perf_counter()
+    match_mode = job.get("match_mode", "strict")
+    with open(job["base"], "rb") as f:
+        base_orders, base_keys = parse_base_orders(read_base_order_lines(f.read(), job["base"]), match_mode)
+    tables, requests = [], []
+    for i, spec in enumerate(job.get("tables", []), 1):
+        with open(spec["path"], "rb") as f:
+            file = BytesIO(f.read())
+        file_hash = hash_file_content(file)
+        sheets = resolve_sheets(load_sheet_names(file_hash, file.getvalue), spec.get("sheets"))
+        sheet_headers = load_headers(file_hash, file.getvalue, sheets)
+        header = merge_sheet_headers(sheet_headers)
+        key = spec["key"]
+        if key not in header:
+            raise ValueError(f"{spec['path']} 未找到「{key}」列！当前表格列名：{header}")
+        mappings = [(m, m) if isinstance(m, str) else (m[0], m[1]) for m in spec.get("mappings", [])]
+        missing = [o for o, _ in mappings if o not in header]
+        if missing:
+            raise ValueError(f"{spec['path']} 未找到映射列：{missing}")
+        requests.append((file_hash, file.getvalue, sheet_headers, tuple([key] + [o for o, _ in mappings])))
+        tables.append({"name": spec.get("name", f"表{i}"), "key": key, "mappings": mappings, "aliases": None})
+    # 各表一起读取，缓存没命中的表并行解析
+    for spec, table, df in zip(job.get("tables", []), tables, load_sheets_columns_many(requests)):
+        if isinstance(df, Exception):
+            raise ValueError(f"{spec['path']} 读取失败：{df}") from df
+        table.update(df=df, index=build_match_index(df[table["key"]]))
+    fmt = job.get("format") or export_format_from_path(job["output"])
+    result = run_integration(base_orders, base_keys, match_mode, tables, job["output"], fmt, job.get("history"))
+    return {
+        "output": job["output"],
+        "rows": len(result["df"]),
+        "sheets": result["sheets"],
+        "unmatched": len(result["unmatched"]),
+        "matched": {name: int(flags.sum()) for name, flags in result["matched"].items()},
+        "seconds": round(time.perf_counter() - started, 3),
+    }
+
+# --------------------------
+# 9. 性能诊断：每个阶段的耗时、CPU 时间、内存变化，追加写入 JSONL 日志，方便按天汇总分位数
+# --------------------------
+PROFILE_ENABLED = os.environ.get("WMS_PROFILE", "0") not in ("", "0")
+PROFILE_LOG_PATH = os.environ.get("WMS_PROFILE_LOG", os.path.join(os.path.dirname(os.path.abspath(__file__)), "wms_profile.jsonl"))
+
+def current_rss():
+    """进程当前常驻内存（字节）：装了 psutil 用 psutil，Linux 读 /proc，都没有时返回 None"""
+    if HAS_PSUTIL:
+        return psutil.Process().memory_info().rss
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        return None
+
+def rss_delta_mb(start, end):
+    """两次 current_rss() 之间的内存变化（MB），取不到内存时为 None"""
+    return None if start is None or end is None else round((end - start) / 1024 / 1024, 2)
+
+class StageProfiler:
+    """
+    记录一次运行（一次页面重跑 / 一次整合）里各阶段的墙钟耗时、CPU 时间和常驻内存变化
+    enabled=False 时 stage() 什么都不做，正常使用没有额外开销
+    CPU 时间只算本进程：进程池里并行解析用的 CPU 不计入，墙钟耗时照常计入
+    """
+    def __init__(self, run, enabled=True):
+        self.run = run
+        self.enabled = enabled
+        self.stages = []
+        self.started = time.perf_counter()
+        self.started_cpu = time.process_time()
+        self.started_rss = current_rss() if enabled else None
+
+    @contextmanager
+    def stage(self, name, **info):
+        """with profiler.stage("parse", tables=2): ... 记录一个阶段，info 是附带的说明（表名、行数等）"""
+        if not self.enabled:
+            yield
+            return
+        rss, cpu, wall = current_rss(), time.process_time(), time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages.append({
+                "stage": name,
+                "wall_s": round(time.perf_counter() - wall, 4),
+                "cpu_s": round(time.process_time() - cpu, 4),
+                "mem_delta_mb": rss_delta_mb(rss, current_rss()),
+                **info,
+            })
+
+    def record(self, **info):
+        """整次运行的汇总（日志里的一行）：总耗时、总 CPU 时间、内存变化、当前内存和各阶段明细"""
+        rss = current_rss()
+        return {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "run": self.run,
+            "wall_s": round(time.perf_counter() - self.started, 4),
+            "cpu_s": round(time.process_time() - self.started_cpu, 4),
+            "mem_delta_mb": rss_delta_mb(self.started_rss, rss),
+            "rss_mb": None if rss is None else round(rss / 1024 / 1024, 1),
+            **info,
+            "stages": self.stages,
+        }
+
+def append_profile_log(record, path=PROFILE_LOG_PATH):
+    """追加一行 JSON 到诊断日志；写不进去（只读目录等）时返回 False，不影响正常使用"""
+    try:
+        with open(path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+        return True
+    except OSError:
+        return False
+
+def summarize_profile_log(path=PROFILE_LOG_PATH, days=None):
+    """
+    按（运行类型, 阶段）汇总诊断日志的耗时分位数，阶段为 "total" 的行是整次运行
+    days 给定时只统计最近 days 天；日志不存在或为空时返回空表
+    """
+    since = time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(time.time() - days * 86400)) if days else ""
+    rows = []
+    if os.path.exists(path):
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # 写到一半的行（进程被杀）跳过
+                    continue
+                if record.get("time", "") < since:
+                    continue
+                rows.append((record["run"], "total", record["wall_s"], record.get("cpu_s")))
+                rows.extend((record["run"], s["stage"], s["wall_s"], s.get("cpu_s")) for s in record.get("stages", []))
+    columns = ["run", "stage", "count", "p50_s", "p90_s", "p99_s", "max_s", "cpu_p50_s"]
+    if not rows:
+        return pd.DataFrame(columns=columns)
+    df = pd.DataFrame(rows, columns=["run", "stage", "wall_s", "cpu_s"])
+    grouped = df.groupby(["run", "stage"], sort=False)
+    summary = grouped["wall_s"].agg(
+        count="count",
+        p50_s=lambda s: s.quantile(0.5),
+        p90_s=lambda s: s.quantile(0.9),
+        p99_s=lambda s: s.quantile(0.99),
+        max_s="max",
+    )
+    summary["cpu_p50_s"] = grouped["cpu_s"].median()
+    return summary.round(4).reset_index()[columns]
+
+# --------------------------
+# 10. 进程内共享存储：同一个文件不管多少个会话在用，只解析一次、内存里只存一份
+# --------------------------
+# 共享存储的内存上限（MB）：超出时淘汰没有会话在用的条目（最久没用的先淘汰），正在用的不淘汰
+SHARED_STORE_MAX_BYTES = int(float(os.environ.get("WMS_SHARED_MAX_MB", "4096")) * 1024 * 1024)
+
+class SharedStore:
+    """
+    Streamlit 的所有会话都在同一个进程里，解析好的列、匹配索引按（内容hash, 工作表, 列）放在这里共用：
+    - 只读：取出来的 DataFrame / 索引谁都不能改（需要改时先复制）
+    - 引用计数：每个会话（owner）登记自己正在用哪些条目，会话结束（会话状态被回收）时自动注销
+    - 内存预算：总大小超过上限时，按最久没用的顺序淘汰没有会话在用的条目
+    - 同一个条目同时只有一个会话在生成，其他会话等它生成完直接取
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        # key → {"value": 数据, "bytes": 大小, "refs": 正在用它的 owner 集合}，按最近使用排序
+        self.entries = OrderedDict()
+        # owner → 它正在用的 key 集合
+        self.holds = {}
+        # key → 正在生成这个条目的锁
+        self.loading = {}
+        self.bytes = 0
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0}
+
+    def get_or_load_many(self, keys, load, size, owner=None):
+        """
+        一次取多个条目，返回和 keys 对应的列表：有的直接取；没有的加锁后一起交给 load(缺的 key 列表) 批量生成
+        load 返回和传入 key 对应的值列表，其中的异常对象原样返回、不放进存储；size(值) 返回占用的字节数
+        owner 给定时取到的条目马上登记为该 owner 在用，不会被其他会话的写入挤掉
+        """
+        results = dict(zip(keys, self.lookup(keys, owner)))
+        missing = [k for k in results if results[k] is None]
+        if not missing:
+            self.count(len(results), 0)
+            return [results[k] for k in keys]
+        with self.lock:
+            locks = [self.loading.setdefault(k, threading.Lock()) for k in missing]
+        # 固定顺序加锁，两个会话各缺几个相同的条目也不会互相等死
+        for lock in sorted(set(locks), key=id):
+            lock.acquire()
+        try:
+            # 等锁期间别的会话可能已经生成好了
+            for k, value in zip(missing, self.lookup(missing, owner)):
+                results[k] = value
+            todo = [k for k in missing if results[k] is None]
+            # 等别的会话生成好的也算命中：这次没有重新解析
+            self.count(len(results) - len(todo), len(todo))
+            if todo:
+                for k, value in zip(todo, load(todo)):
+                    results[k] = value
+                    if not isinstance(value, Exception):
+                        self.put(k, value, size(value), owner)
+        finally:
+            for lock in set(locks):
+                lock.release()
+            with self.lock:
+                for k in missing:
+                    self.loading.pop(k, None)
+        return [results[k] for k in keys]
+
+    def count(self, hits, misses):
+        with self.lock:
+            self.stats["hits"] += hits
+            self.stats["misses"] += misses
+
+    def lookup(self, keys, owner=None):
+        """取已有的条目（没有的为 None）"""
+        values = []
+        with self.lock:
+            for k in keys:
+                entry = self.entries.get(k)
+                if entry is None:
+                    values.append(None)
+                    continue
+                self.entries.move_to_end(k)
+                if owner is not None:
+                    entry["refs"].add(owner)
+                    self.holds.setdefault(owner, set()).add(k)
+                values.append(entry["value"])
+        return values
+
+    def put(self, key, value, nbytes, owner=None):
+        with self.lock:
+            if key not in self.entries:
+                self.entries[key] = {"value": value, "bytes": nbytes, "refs": set()}
+                self.bytes += nbytes
+            if owner is not None:
+                self.entries[key]["refs"].add(owner)
+                self.holds.setdefault(owner, set()).add(key)
+            self.evict()
+
+    def set_holds(self, owner, keys):
+        """owner 现在在用的条目改成 keys（不在里面的都释放），释放后超出预算的马上淘汰"""
+        keys = {k for k in keys if k is not None}
+        with self.lock:
+            old = self.holds.pop(owner, set())
+            for k in old - keys:
+                if k in self.entries:
+                    self.entries[k]["refs"].discard(owner)
+            kept = set()
+            for k in keys:
+                if k in self.entries:
+                    self.entries[k]["refs"].add(owner)
+                    kept.add(k)
+            if kept:
+                self.holds[owner] = kept
+            self.evict()
+
+    def release_owner(self, owner):
+        """会话结束：释放它在用的全部条目"""
+        self.set_holds(owner, ())
+
+    def evict(self):
+        """调用方已持有锁：超出预算时按最久没用的顺序淘汰没人在用的条目"""
+        if self.bytes <= self.max_bytes:
+            return
+        for k in [k for k, entry in self.entries.items() if not entry["refs"]]:
+            if self.bytes <= self.max_bytes:
+                break
+            self.bytes -= self.entries.pop(k)["bytes"]
+            self.stats["evictions"] += 1
+
+    def clear_unused(self):
+        """清掉所有没有会话在用的条目"""
+        with self.lock:
+            for k in [k for k, entry in self.entries.items() if not entry["refs"]]:
+                self.bytes -= self.entries.pop(k)["bytes"]
+                self.stats["evictions"] += 1
+
+    def usage(self):
+        """当前状态：条目数、在用条目数、常驻字节数、在用字节数、会话数、命中/未命中/淘汰次数"""
+        with self.lock:
+            in_use = [entry for entry in self.entries.values() if entry["refs"]]
+            return {
+                "entries": len(self.entries),
+                "in_use": len(in_use),
+                "bytes": self.bytes,
+                "in_use_bytes": sum(entry["bytes"] for entry in in_use),
+                "owners": len(self.holds),
+                **self.stats,
+            }
+
+SHARED_STORE = SharedStore(SHARED_STORE_MAX_BYTES)
+
+class StoreOwner:
+    """
+    一个会话在共享存储里的身份：放进会话状态，会话结束（或重置）后对象被回收，自动释放它在用的条目
+    """
+    def __init__(self, store=SHARED_STORE):
+        self.id = uuid.uuid4().hex
+        weakref.finalize(self, store.release_owner, self.id)
+
+# --------------------------
+# 11. 历史订单库：上传过的表存进本地 SQLite，以后整合直接按匹配键查，不用再传一遍
+# --------------------------
+# 历史订单库文件，设为 0 关闭
+HISTORY_DB_PATH = os.environ.get("WMS_HISTORY_DB", os.path.join(os.path.dirname(os.path.abspath(__file__)), "wms_history.sqlite3"))
+HISTORY_DISABLED_PATHS = ("", "0")
+HISTORY_ENABLED = HISTORY_DB_PATH not in HISTORY_DISABLED_PATHS
+# 从历史库取出来的表里订单号那一列的列名
+HISTORY_KEY_COLUMN = "__history_key__"
+# 每次写入 / 查询交给 SQLite 的行数
+HISTORY_BATCH_ROWS = 50000
+
+HISTORY_SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    source TEXT PRIMARY KEY,      -- 文件hash + 工作表 + 主键列，同一份数据只导入一次
+    file_hash TEXT NOT NULL,
+    name TEXT NOT NULL,
+    key_column TEXT NOT NULL,
+    columns TEXT NOT NULL,        -- JSON 列名列表
+    rows INTEGER NOT NULL,
+    imported_at TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS orders (
+    strict_key TEXT PRIMARY KEY,  -- 严格模式匹配键（也就是还原+号后的完整订单号）
+    loose_key TEXT,               -- 宽松模式匹配键（只有数字），没有数字时为 NULL
+    file_hash TEXT NOT NULL,
+    data TEXT NOT NULL            -- JSON {列名: 值}，不含主键列
+);
+CREATE INDEX IF NOT EXISTS orders_loose_key ON orders (loose_key);
+"""
+
+def history_connect(path=HISTORY_DB_PATH):
+    """打开历史库（没有就新建）；多个会话同时读写时等锁，不直接报错"""
+    if path in HISTORY_DISABLED_PATHS:
+        raise ValueError("历史订单库已关闭（WMS_HISTORY_DB=0）")
+    conn = sqlite3.connect(path, timeout=60)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.executescript(HISTORY_SCHEMA)
+    return conn
+
+def history_source(file_hash, sheets, key):
+    """一份导入数据的标识：同一个文件的同样几个工作表、同一个主键列只导入一次"""
+    return "\x00".join([file_hash, *[str(s) for s in sheets], key])
+
+def history_ingest(df, key, file_hash, name, sheets=(), path=HISTORY_DB_PATH):
+    """
+    把一张表存进历史库，返回写入的订单数（这份数据导入过就返回 None，不重复写）
+    - 按严格模式匹配键去重：同一个文件里取第一次出现的行，和整合时一致
+    - 不同文件里有同一个订单时按列合并：各文件的列都保留，两份都有的列以后导入的为准
+    - 主键为空的行不存
+    """
+    source = history_source(file_hash, sheets, key)
+    conn = history_connect(path)
+    try:
+        if conn.execute("SELECT 1 FROM files WHERE source = ?", (source,)).fetchone():
+            return None
+        strict = clean_order_ids(df[key], "strict")
+        keep = (strict != "") & ~strict.duplicated()
+        strict = strict[keep]
+        loose = clean_order_ids(strict, "loose")
+        columns = [c for c in df.columns if c != key]
+        data = df.loc[keep, columns].astype(str)
+        with conn:
+            for start in range(0, len(strict), HISTORY_BATCH_ROWS):
+                stop = start + HISTORY_BATCH_ROWS
+                # 整块转 JSON 行（C 实现），不逐行 json.dumps
+                # 只按 "\n" 切：单元格里的换行会被转义，但 \x85、\u2028 这类字符原样保留，splitlines 会把它们也当成换行
+                chunk = data.iloc[start:stop]
+                if columns:
+                    records = chunk.to_json(orient="records", lines=True, force_ascii=False).rstrip("\n").split("\n")
+                else:
+                    # 只有主键列的表：pandas 对没有列的表不输出记录，每个订单存一个空对象
+                    records = ["{}"] * len(chunk)
+                if len(records) != len(chunk):
+                    raise ValueError(f"历史库写入失败：{len(chunk)} 行数据转出了 {len(records)} 条记录")
+                conn.executemany(
+                    "INSERT INTO orders (strict_key, loose_key, file_hash, data) VALUES (?, NULLIF(?, ''), ?, ?) "
+                    "ON CONFLICT (strict_key) DO UPDATE SET loose_key = excluded.loose_key, "
+                    "file_hash = excluded.file_hash, data = json_patch(data, excluded.data)",
+                    zip(strict.iloc[start:stop], loose.iloc[start:stop], [file_hash] * len(records), records),
+                )
+            conn.execute(
+                "INSERT INTO files VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (source, file_hash, name, key, json.dumps(columns, ensure_ascii=False), len(strict),
+                 time.strftime("%Y-%m-%d %H:%M:%S")),
+            )
+        return len(strict)
+    finally:
+        conn.close()
+
+def history_stats(path=HISTORY_DB_PATH):
+    """历史库概况：订单数、导入过的文件列表、所有文件的列名并集（按出现顺序）、库文件大小；库不存在或已关闭时返回 None"""
+    if path in HISTORY_DISABLED_PATHS or not os.path.exists(path):
+        return None
+    conn = history_connect(path)
+    try:
+        orders = conn.execute("SELECT COUNT(*) FROM orders").fetchone()[0]
+        files = conn.execute("SELECT name, key_column, columns, rows, imported_at FROM files ORDER BY imported_at").fetchall()
+    finally:
+        conn.close()
+    columns = list(dict.fromkeys(c for f in files for c in json.loads(f[2])))
+    return {
+        "orders": orders,
+        "files": [{"name": f[0], "key": f[1], "rows": f[3], "imported_at": f[4]} for f in files],
+        "columns": columns,
+        "bytes": os.path.getsize(path),
+    }
+
+def history_fetch(base_keys, match_mode, columns, path=HISTORY_DB_PATH):
+    """
+    按基准匹配键从历史库取订单：匹配键放进临时表，和订单表按索引 JOIN，一次查完（不逐个查询）
+    宽松模式一个匹配键可能对应多个订单，取最先进库的那个（按订单第一次导入的先后；之后再导入只合并数据，不改先后）
+    返回只含匹配到的订单的表：订单号列（HISTORY_KEY_COLUMN）+ 要取的列，可以像上传的表一样建匹配索引、参与整合
+    """
+    conn = history_connect(path)
+    try:
+        # 临时表不建索引（匹配键已经去重），逐个在订单表的主键 / 宽松键索引上查
+        conn.execute("PRAGMA temp_store=MEMORY")
+        conn.execute("CREATE TEMP TABLE query (key TEXT)")
+        keys = [k for k in dict.fromkeys(base_keys) if k != ""]
+        for start in range(0, len(keys), HISTORY_BATCH_ROWS):
+            conn.executemany("INSERT INTO query VALUES (?)", ((k,) for k in keys[start:start + HISTORY_BATCH_ROWS]))
+        if match_mode == "strict":
+            sql = "SELECT o.strict_key, o.data FROM query q JOIN orders o ON o.strict_key = q.key"
+        else:
+            sql = ("SELECT o.strict_key, o.data FROM query q JOIN orders o "
+                   "ON o.rowid = (SELECT MIN(rowid) FROM orders WHERE loose_key = q.key)")
+        rows = conn.execute(sql).fetchall()
+    finally:
+        conn.close()
+    records = [json.loads(data) for _, data in rows]
+    df = pd.DataFrame({HISTORY_KEY_COLUMN: [order for order, _ in rows]})
+    for c in columns:
+        df[c] = [r.get(c, "") for r in records]
+    return compact_table(df, HISTORY_KEY_COLUMN)
+
+def history_ingest_file(path, key, sheets=None, db_path=HISTORY_DB_PATH):
+    """把一个表格文件（默认第一个工作表，sheets 同 run_job）的全部列存进历史库，返回写入的订单数，导入过的返回 None"""
+    with open(path, "rb") as f:
+        file = BytesIO(f.read())
+    file_hash = hash_file_content(file)
+    sheets = resolve_sheets(load_sheet_names(file_hash, file.getvalue), sheets)
+    sheet_headers = load_headers(file_hash, file.getvalue, sheets)
+    header = merge_sheet_headers(sheet_headers)
+    if key not in header:
+        raise ValueError(f"{path} 未找到「{key}」列！当前表格列名：{header}")
+    columns = tuple([key] + [c for c in header if c != key])
+    df = load_sheets_columns_many([(file_hash, file.getvalue, sheet_headers, columns)])[0]
+    if isinstance(df, Exception):
+        raise df
+    return history_ingest(df, key, file_hash, os.path.basename(path), tuple(sheets), db_path)
+
+def history_clear(path=HISTORY_DB_PATH):
+    """删除整个历史库"""
+    if path in HISTORY_DISABLED_PATHS:
+        return
+    for suffix in ("", "-wal", "-shm"):
+        try:
+            os.remove(path + suffix)
+        except FileNotFoundError:
+            pass
+
+# --------------------------
+# 12. 后台整合：整合放到后台线程里跑，合并、导出循环里汇报进度，可以随时取消
+# --------------------------
+def run_integration(base_orders, base_keys, match_mode, tables, output, fmt="xlsx", history_columns=None,
+                    progress=None, profiler=None):
+    """
+    一次完整整合（页面和 run_job 共用）：查历史库（可选）→ 按映射取列 → 求未匹配订单 → 导出到 output
+    output 为 None 时不导出（页面上点下载时才按格式生成），返回的工作表数量为 None
+    history_columns：从历史订单库取的列，历史库当成一张名为「历史库」的表参与整合
+    progress：可选，progress(阶段, 已完成, 总数)，在合并、导出的循环里调用；它抛出的异常会中止整合
+    返回 {"df": 结果表, "matched": 各表匹配标记, "unmatched": 未匹配行号, "sheets": 工作表数量, "tables": 参与整合的表数}
+    """
+    profiler = profiler or StageProfiler("integrate", False)
+    tables = list(tables)
+    if history_columns:
+        if progress is not None:
+            progress("history", 0, 1)
+        with profiler.stage("history", columns=len(history_columns)):
+            history_df = history_fetch(base_keys, match_mode, history_columns)
+            tables.append({"name": "历史库", "df": history_df, "index": build_match_index(history_df[HISTORY_KEY_COLUMN]),
+                           "mappings": [(c, c) for c in history_columns], "aliases": None})
+    with profiler.stage("merge", tables=len(tables)):
+        final_df, matched = integrate_tables(base_orders, base_keys, match_mode, tables, progress)
+    with profiler.stage("unmatched"):
+        unmatched = find_unmatched(matched, len(final_df))
+    sheets = None
+    if output is not None:
+        with profiler.stage("export", format=fmt):
+            sheets = export_result(final_df, output, fmt, progress)
+    return {"df": final_df, "matched": matched, "unmatched": unmatched, "sheets": sheets, "tables": len(tables)}
+
+def integration_fingerprint(base_source, match_mode, tables, history=None):
+    """
+    整合输入的指纹：基准订单来源（输入内容的hash）、匹配模式、各表（来源、映射、人工配对）、历史库取数都没变，整合结果就不变
+    tables 里每张表除了 run_integration 要的字段，还要带 "source"：(文件hash, 工作表, 主键列)
+    history：可选，(取数列, 历史库版本)，历史库存进了新数据时版本跟着变
+    """
+    payload = {
+        "base": list(base_source or ()),
+        "match_mode": match_mode,
+        "tables": [
+            [table["name"], list(table["source"]), [list(m) for m in table["mappings"]],
+             sorted((table.get("aliases") or {}).items())]
+            for table in tables
+        ],
+        "history": history,
+    }
+    return hashlib.sha256(json.dumps(payload, ensure_ascii=False, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+class JobCancelled(Exception):
+    """后台任务被取消（由 BackgroundJob.report 在下一次汇报进度时抛出）"""
+
+class BackgroundJob:
+    """
+    在后台线程里跑 fn(job)，页面照常响应：
+    - fn 里周期性调用 job.report(阶段, 已完成, 总数) 汇报进度；取消后下一次 report 抛 JobCancelled，fn 就地中止
+    - 页面定时读 snapshot() 显示进度和预计剩余时间，结束后从 result / error 取结果
+    只用线程不用进程：整合用的表都在本进程的共享存储里，换进程就得把整张表序列化一遍
+    pandas / pyarrow 的大块计算会释放 GIL，后台跑整合时页面重跑只是稍慢
+    """
+    def __init__(self, fn, name="整合"):
+        self.name = name
+        self.status = "running"
+        self.result = None
+        self.error = None
+        self.cancel_event = threading.Event()
+        self.lock = threading.Lock()
+        self.stage, self.done, self.total = "start", 0, 0
+        self.started = self.stage_started = time.perf_counter()
+        self.finished = None
+        self.thread = threading.Thread(target=self._run, args=(fn,), name=f"wms-{name}", daemon=True)
+        self.thread.start()
+
+    def _run(self, fn):
+        try:
+            result, status, error = fn(self), "done", None
+        except JobCancelled:
+            result, status, error = None, "cancelled", None
+        except Exception as e:
+            result, status, error = None, "failed", e
+        with self.lock:
+            self.result, self.error, self.status = result, error, status
+            self.finished = time.perf_counter()
+
+    def report(self, stage, done, total):
+        """汇报进度；已经取消时抛 JobCancelled"""
+        if self.cancel_event.is_set():
+            raise JobCancelled()
+        with self.lock:
+            if stage != self.stage:
+                self.stage, self.stage_started = stage, time.perf_counter()
+            self.done, self.total = done, total
+
+    def cancel(self):
+        """请求取消：后台线程在下一次汇报进度时停下（正在进行的单步操作会先做完）"""
+        self.cancel_event.set()
+
+    @property
+    def running(self):
+        return self.status == "running"
+
+    def snapshot(self):
+        """当前进度：阶段、已完成 / 总数、本阶段预计剩余秒数（按本阶段到目前的速度估算，算不出时为 None）、已用秒数"""
+        with self.lock:
+            now = self.finished or time.perf_counter()
+            eta = None
+            if self.running and 0 < self.done < self.total:
+                eta = (now - self.stage_started) / self.done * (self.total - self.done)
+            return {
+                "status": self.status, "stage": self.stage, "done": self.done, "total": self.total,
+                "eta_s": eta, "elapsed_s": now - self.started, "cancelling": self.cancel_event.is_set(),
+            }